@@ -0,0 +1,465 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+import pymupdf
+
+import pdf_processing_v4 as pp
+
+
+### CORPUS ###
+
+def load_raw_corpus(pdf_folder):
+    """
+    Load the raw text of every PDF in a folder (pages joined with form feeds).
+
+    Returns:
+        dict: {file name: raw text}
+    """
+    corpus = {}
+    for file_name in sorted(os.listdir(pdf_folder)):
+        if file_name.lower().endswith('.pdf'):
+            with pymupdf.open(os.path.join(pdf_folder, file_name)) as doc:
+                corpus[file_name] = '\f'.join(page.get_text("text") for page in doc)
+    return corpus
+
+# Transcript folder from config.json
+def get_pdf_folder():
+    return pp.get_folder_paths(pp.load_config())['transcripts_pdf_folder'] or 'transcripts_pdf'
+
+# Best of several timed runs of func over all texts
+def time_function(func, texts, repeats=5):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for text in texts:
+            func(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def print_comparison(name, before_seconds, after_seconds, corpus_mb):
+    print(f"{name:<40} before {corpus_mb / before_seconds:8.1f} MB/s   after {corpus_mb / after_seconds:8.1f} MB/s   speedup {before_seconds / after_seconds:5.1f}x")
+
+
+### 1. CHARACTER REPLACEMENTS ###
+
+# Previous implementations: one str.replace per dictionary entry
+def legacy_clean_special_characters(text):
+    replacements = {
+        '\ufffd': '',
+        '\u2022': '•',
+        '\u2018': "'",
+        '\u2019': "'",
+        '\u201c': '"',
+        '\u201d': '"',
+        '\u2013': '-',
+        '\u2014': '--',
+        '\u00a9': '',
+    }
+    for char, replacement in replacements.items():
+        text = text.replace(char, replacement)
+    return text
+
+def legacy_add_text_tags_replacements(text):
+    try:
+        text = text.encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
+    except (UnicodeError, AttributeError):
+        pass
+    replacements = {
+        '\ufffd': '',
+        '\u2022': '•',
+        '\u2018': "'",
+        '\u2019': "'",
+        '\u201c': '"',
+        '\u201d': '"',
+        '\u2013': '-',
+        '\u2014': '--',
+        '\u00a9': '',
+        '\u00a0': ' <NBSP> ',
+        '\f': ' <PAGEBREAK> ',
+        '\n': ' <TAG_2> ',
+        '\t': ' <TAB> ',
+    }
+    for char, replacement in replacements.items():
+        text = text.replace(char, replacement)
+    return text
+
+# Replacements in add_text_tags, before its regex substitutions
+def add_text_tags_replacements(text):
+    try:
+        text.encode('utf-8')
+    except UnicodeEncodeError:
+        text = text.encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
+    return pp.replace_characters(text, pp.TEXT_TAG_REPLACEMENTS)
+
+def benchmark_replacements(corpus):
+    """Compare the previous replacement loops with the shared replace_characters normalizer."""
+    texts = list(corpus.values())
+    corpus_mb = sum(len(text.encode('utf-8')) for text in texts) / 1e6
+
+    # Single-pass str.translate table, for reference
+    translate_table = str.maketrans({**pp.TEXT_TAG_REPLACEMENTS, **{chr(code): None for code in range(0xD800, 0xE000)}})
+
+    for text in texts + ['a\ud800b\u00a0c\u2014\n']:
+        assert pp.clean_special_characters(text) == legacy_clean_special_characters(text)
+        assert add_text_tags_replacements(text) == legacy_add_text_tags_replacements(text)
+        assert text.translate(translate_table) == legacy_add_text_tags_replacements(text)
+
+    print_comparison("clean_special_characters",
+                     time_function(legacy_clean_special_characters, texts),
+                     time_function(pp.clean_special_characters, texts), corpus_mb)
+    print_comparison("add_text_tags replacements",
+                     time_function(legacy_add_text_tags_replacements, texts),
+                     time_function(add_text_tags_replacements, texts), corpus_mb)
+    print_comparison("str.translate table",
+                     time_function(legacy_add_text_tags_replacements, texts),
+                     time_function(lambda text: text.translate(translate_table), texts), corpus_mb)
+
+
+### 2. REGEX PATTERNS ###
+
+# Previous implementations with string patterns, compiled through the re module cache on every call
+def legacy_normalize_punctuation(text):
+    """Move punctuation outside of bold tags."""
+    # Manage colons
+    # text = re.sub(r'(\w):', r'\1 :', text) # add space before colon
+    text = re.sub(r':(\w)', r': \1', text)  # add space after colon
+    text = re.sub(r'(\w+)\s+:', r'\1:', text)  # remove space before colon
+
+    # Remove isolated punctuation marks like " : "
+    text = re.sub(r'\s+([,.;:!?])\s+', ' ', text)
+    
+    # Strip leading/trailing whitespace
+    text = text.strip()
+    
+    return text
+
+
+def legacy_optimize_text_tags(text):
+    """Optimize text tags by removing unnecessary formatting tags."""
+
+    # Remove TEXT tags with single letter, number or punctuation (from "<TAG> [char] <TAG>" to "<TAG>")
+    text = re.sub(r'<TAG_2>\s*[A-Za-z]\s*<TAG_2>', r' <TAG_2> ', text, flags=re.IGNORECASE)
+    text = re.sub(r'<TAG_2>\s*(\d+)\s*<TAG_2>', r' <TAG_2>', text, flags=re.IGNORECASE)
+    text = re.sub(r'<TAG_2>\s*[,.;:!?-]\s*<TAG_2>', r' <TAG_2>', text, flags=re.IGNORECASE)
+    text = re.sub(r'<TAG_3>\s*[A-Za-z]\s*<TAG_3>', r' <TAG_3> ', text, flags=re.IGNORECASE)
+    text = re.sub(r'<TAG_3>\s*(\d+)\s*<TAG_3>', r' <TAG_3>', text, flags=re.IGNORECASE)
+    text = re.sub(r'<TAG_3>\s*[,.;:!?-]\s*<TAG_3>', r' <TAG_3>', text, flags=re.IGNORECASE)
+    text = re.sub(r'<TAG_4>\s*[A-Za-z]\s*<TAG_4>', r' <TAG_4> ', text, flags=re.IGNORECASE)
+    text = re.sub(r'<TAG_4>\s*(\d+)\s*<TAG_4>', r' <TAG_4> ', text, flags=re.IGNORECASE)
+
+    # optimize multiple TEXT tags in a row, keep only one
+    text = re.sub(r'(<TAG_4>\s*){2,}', r'\1', text)
+    text = re.sub(r'(<TAG_3>\s*){2,}', r'\1', text)
+    text = re.sub(r'(<TAG_2>\s*){2,}', r'\1', text)
+
+    # Ensure single space between tags
+    text = re.sub(r'>\s+<', '> <', text)
+    text = re.sub(r'><', '> <', text)
+    
+    return text
+
+
+def legacy_optimize_word_tags(text):
+    """Clean up text by removing unnecessary formatting tags."""
+
+    # Remove WORD tags if they are around punctuation, numbers and single letters (from "<BOLD-> [char]] <-BOLD>" to "")
+    text = re.sub(r'<BOLD->\s*([:,.;?!])\s*<-BOLD>', r' \1 ', text)
+    text = re.sub(r'<BOLD->\s*([A-Za-z])\s*<-BOLD>', r' \1 ', text)
+    text = re.sub(r'<BOLD->\s*(\d+)\s*<-BOLD>', r' \1 ', text)
+    
+    # Optimize multiple WORD tags
+    text = re.sub(r'<-BOLD>\s*<BOLD->', '', text)
+
+    # Ensure single space between tags
+    text = re.sub(r'>\s+<', '> <', text)
+    text = re.sub(r'><', '> <', text)
+
+    # Normalize spaces
+    text = re.sub(r'\s+', ' ', text).strip()
+    
+    return text
+
+
+def legacy_remove_repeating_punctuation(text):
+    """Remove repeating punctuation characters."""
+    # Handle cases where punctuation is separated by spaces
+    text = re.sub(r'([.!?](\s+))\1{2,}', '', text)
+    
+    # Handle continuous repeating punctuation (like "............")
+    text = re.sub(r'([.!?])\1{2,}', '', text)
+    
+    # Handle cases where dots are mixed with spaces in long sequences
+    text = re.sub(r'([.]\s*){2,}', '', text)
+    
+    return text
+
+
+def legacy_normalize_adjacent_uppercase_words(text):
+    """Convert likely names (adjacent uppercase words) to Title Case."""
+    # Change "OPERATOR" to "Operator"
+    text = re.sub(r'\bOPERATOR\b', 'Operator', text)
+
+    # Pattern for two or more adjacent uppercase words, optionally with a middle initial
+    pattern = r'\b([A-Z][A-Z\'\-]+)(\s+[A-Z]\.?\s+)?(\s+[A-Z][A-Z\'\-]+)\b' # original
+    #pattern = r'\b([A-Z][A-Z\'\-]+)(?:\s+([A-Z]\.?)?\s+)?([A-Z][A-Z\'\-]+)\b'  # supposed to tackle apostrophes
+
+    def convert_to_title(match):
+        first = match.group(1).title()
+        middle = match.group(2) if match.group(2) else ''
+        last = match.group(3).title()
+        return f"{first}{middle}{last}"
+    
+    return re.sub(pattern, convert_to_title, text)
+
+
+def legacy_fix_tag_spacing(text):
+    """Fix tag spacing issues that commonly occur in Q/A sections"""
+    # Fix all TAG_# variations (TAG_2, TAG_3, TAG_4, etc.)
+    text = re.sub(r'<\s*T\s*A\s*G\s*_\s*(\d+)\s*>', r'<TAG_\1>', text)
+
+    # Fix BOLD tags
+    text = re.sub(r'<\s*B\s*O\s*L\s*D\s*-\s*>', r'<BOLD->', text)
+    text = re.sub(r'<\s*-\s*B\s*O\s*L\s*D\s*>', r'<-BOLD>', text)
+    return text
+
+# Previous add_text_tags: replacement loop, round trip and string patterns
+def legacy_add_text_tags(text):
+    text = legacy_add_text_tags_replacements(text)
+    text = re.sub(r'[ ]{2,}', ' <TAG_3> ', text)
+    text = re.sub(r'<TAG_3>\s*<TAG_2>', ' <TAG_4> ', text)
+    text = re.sub(r'>\s+<', '> <', text)
+    text = re.sub(r'><', '> <', text)
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text
+
+def legacy_remove_brackets(utterances):
+    debug_counts = {'angle_brackets': 0, 'parentheses': 0, 'double_slashes': 0, 'backslashes': 0}
+    cleaned = []
+    for utterance in utterances:
+        text = utterance['utterance']
+        angle_brackets_count = len(re.findall(r'<[^>]*>', text))
+        text = re.sub(r'<[^>]*>', '', text)
+        debug_counts['angle_brackets'] += angle_brackets_count
+        parentheses_count = len(re.findall(r'\([^)]*\)', text))
+        text = re.sub(r'\([^)]*\)', '', text)
+        debug_counts['parentheses'] += parentheses_count
+        double_slashes_count = len(re.findall(r'//[^/]*//', text))
+        text = re.sub(r'//[^/]*//', '', text)
+        debug_counts['double_slashes'] += double_slashes_count
+        backslashes_count = len(re.findall(r'\\[^\\]*\\', text))
+        text = re.sub(r'\\[^\\]*\\', '', text)
+        debug_counts['backslashes'] += backslashes_count
+        cleaned.append(' '.join(text.split()))
+    return cleaned, debug_counts
+
+def remove_brackets(utterances):
+    debug_counts = {'angle_brackets': 0, 'parentheses': 0, 'double_slashes': 0, 'backslashes': 0}
+    cleaned = []
+    for utterance in utterances:
+        text = utterance['utterance']
+        for cleaning_type in ('angle_brackets', 'parentheses', 'double_slashes', 'backslashes'):
+            text, count = pp.TEXT_PATTERNS[cleaning_type].subn('', text)
+            debug_counts[cleaning_type] += count
+        cleaned.append(' '.join(text.split()))
+    return cleaned, debug_counts
+
+def benchmark_regex(corpus):
+    """Compare per-function throughput of string patterns with the precompiled TEXT_PATTERNS."""
+    raw_texts = list(corpus.values())
+    tagged_texts = [pp.add_text_tags(text) for text in raw_texts]
+    line_texts = [line for text in raw_texts for line in text.split('\n')]
+    utterances = [[{'utterance': chunk} for chunk in text.split('<TAG_4>')] for text in tagged_texts]
+
+    functions = [
+        ("add_text_tags", legacy_add_text_tags, pp.add_text_tags, raw_texts),
+        ("optimize_text_tags", legacy_optimize_text_tags, pp.optimize_text_tags, tagged_texts),
+        ("optimize_word_tags", legacy_optimize_word_tags, pp.optimize_word_tags, tagged_texts),
+        ("normalize_punctuation", legacy_normalize_punctuation, pp.normalize_punctuation, tagged_texts),
+        ("remove_repeating_punctuation", legacy_remove_repeating_punctuation, pp.remove_repeating_punctuation, tagged_texts),
+        ("fix_tag_spacing", legacy_fix_tag_spacing, pp.fix_tag_spacing, tagged_texts),
+        ("normalize_adjacent_uppercase (per line)", legacy_normalize_adjacent_uppercase_words, pp.normalize_adjacent_uppercase_words, line_texts),
+        ("clean_utterances brackets", legacy_remove_brackets, remove_brackets, utterances),
+    ]
+    for name, legacy_function, function, texts in functions:
+        for text in texts:
+            assert function(text) == legacy_function(text), name
+        input_mb = sum(len(str(text).encode('utf-8')) for text in texts) / 1e6
+        print_comparison(name, time_function(legacy_function, texts), time_function(function, texts), input_mb)
+
+
+### 3. SPEAKER ATTRIBUTION PATTERNS ###
+
+# Previous implementation: deduplication with list membership checks
+def legacy_collect_attribution_patterns(text, docs, matcher):
+    ner_patterns = []
+    matcher_patterns = []
+    all_patterns = []
+
+    formatting_tags = ["<TAG_2>", "<TAG_3>", "<TAG_4>", "<BOLD->"]
+    punctuation_marks = [":", "-", ",", ">"]
+    for doc, offset, core_start, core_end in docs:
+        for ent in doc.ents:
+            if ent.label_ != "PERSON" or not core_start <= offset + ent.start_char < core_end:
+                continue
+            start = max(0, offset + ent.start_char - 2)
+            end = offset + ent.end_char
+            pre_context = text[max(0, start - 10):start]
+            post_context = text[end:min(len(text), end + 15)]
+            if not any(tag in pre_context for tag in formatting_tags):
+                continue
+            start_idx = start
+            for tag in formatting_tags:
+                tag_pos = pre_context.rfind(tag)
+                if tag_pos != -1:
+                    start_idx = start - (len(pre_context) - tag_pos)
+                    break
+            end_idx = end
+            for mark in punctuation_marks:
+                mark_pos = post_context.find(mark)
+                if mark_pos != -1:
+                    end_idx = end + mark_pos + 1
+                    break
+            attribution = text[start_idx:end_idx]
+            if attribution and attribution not in ner_patterns:
+                ner_patterns.append(attribution)
+                all_patterns.append(attribution)
+
+    for doc, offset, core_start, core_end in docs:
+        for match_id, start, end in matcher(doc):
+            span = doc[start:end]
+            if not core_start <= offset + span.start_char < core_end:
+                continue
+            if span.text not in matcher_patterns:
+                matcher_patterns.append(span.text)
+                if span.text not in all_patterns:
+                    all_patterns.append(span.text)
+    return ner_patterns, matcher_patterns, all_patterns
+
+def legacy_extract_patterns(text, docs, matcher):
+    ner_patterns, matcher_patterns, all_patterns = legacy_collect_attribution_patterns(text, docs, matcher)
+    formatted = pp.format_pattern_with_context(ner_patterns, text) + pp.format_pattern_with_context(matcher_patterns, text)
+    return all_patterns, formatted
+
+def extract_patterns(text, docs, matcher):
+    ner_patterns, matcher_patterns = pp.collect_attribution_patterns(text, docs, matcher)
+    formatted = pp.format_pattern_with_context(ner_patterns, text) + pp.format_pattern_with_context(matcher_patterns, text)
+    return list(dict.fromkeys([*ner_patterns, *matcher_patterns])), formatted
+
+def benchmark_attributions(corpus):
+    """Compare list and ordered-set collection of spaCy patterns on the largest PDF (spaCy docs are computed once)."""
+    pdf_folder = get_pdf_folder()
+    file_name = max(corpus, key=lambda name: os.path.getsize(os.path.join(pdf_folder, name)))
+    text = pp.text_processing_pipeline(os.path.join(pdf_folder, file_name), {})
+    nlp = pp.load_nlp()
+    pp.add_tag_special_cases(nlp)
+    docs = list(pp.get_spacy_docs(text, nlp, {}))
+    matcher = pp.get_attribution_matcher(nlp)
+    text_mb = len(text.encode('utf-8')) / 1e6
+
+    ner_patterns, matcher_patterns = pp.collect_attribution_patterns(text, docs, matcher)
+    assert legacy_extract_patterns(text, docs, matcher)[0] == extract_patterns(text, docs, matcher)[0]
+    print(f"{file_name}: {len(text) / 1e6:.1f}M characters, {len(ner_patterns)} NER patterns "
+          f"({sum(len(starts) for starts in ner_patterns.values())} occurrences), {len(matcher_patterns)} matcher patterns "
+          f"({sum(len(starts) for starts in matcher_patterns.values())} occurrences)")
+
+    print_comparison("collect patterns",
+                     time_function(lambda text: legacy_collect_attribution_patterns(text, docs, matcher), [text]),
+                     time_function(lambda text: pp.collect_attribution_patterns(text, docs, matcher), [text]), text_mb)
+    print_comparison("collect and format patterns",
+                     time_function(lambda text: legacy_extract_patterns(text, docs, matcher), [text]),
+                     time_function(lambda text: extract_patterns(text, docs, matcher), [text]), text_mb)
+
+
+### 4. STARTUP ###
+
+# Cumulative import time budget of pdf_processing_v4 (python -X importtime, microseconds)
+IMPORT_TIME_BUDGET_US = 150000
+
+# Heavy dependencies that pdf_processing_v4 imports only in the stages that need them
+LAZY_MODULES = ["spacy", "anthropic", "pymupdf", "dotenv"]
+
+# Best cumulative import time of a module in a fresh interpreter
+def measure_import_time(module_name, repeats=5):
+    best = float('inf')
+    for _ in range(repeats):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+                                capture_output=True, text=True, check=True)
+        for line in result.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module_name:
+                best = min(best, int(fields[1]))
+    return best
+
+def benchmark_startup(corpus):
+    """Check the import time of pdf_processing_v4 against IMPORT_TIME_BUDGET_US and that heavy modules are imported lazily."""
+    result = subprocess.run([sys.executable, "-c", f"import sys, pdf_processing_v4; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"],
+                            capture_output=True, text=True, check=True)
+    loaded = result.stdout.strip()
+    assert not loaded, f"imported at startup: {loaded}"
+
+    import_us = measure_import_time("pdf_processing_v4")
+    print(f"{'import pdf_processing_v4':<40} {import_us / 1000:8.1f} ms   budget {IMPORT_TIME_BUDGET_US / 1000:.0f} ms")
+
+    help_seconds = time_function(lambda args: subprocess.run(args, capture_output=True, check=True),
+                                 [[sys.executable, "pdf_processing_v4.py", "--help"]], repeats=3)
+    print(f"{'pdf_processing_v4.py --help':<40} {help_seconds * 1000:8.1f} ms")
+    assert import_us <= IMPORT_TIME_BUDGET_US, f"import time {import_us / 1000:.1f} ms exceeds the budget of {IMPORT_TIME_BUDGET_US / 1000:.0f} ms"
+
+
+### 5. HEADER AND FOOTER STRIPPING ###
+
+def benchmark_header_footer(corpus):
+    """Compare extraction with and without strip_header_footer and check that the call date of every PDF is still found."""
+    pdf_folder = get_pdf_folder()
+    bank = {"bank_name": None, "reporting_period_format": "{quarter}Q{yy}"}
+    plain_seconds = stripped_seconds = 0.0
+    plain_chars = stripped_chars = 0
+    for file_name in corpus:
+        pdf_path = os.path.join(pdf_folder, file_name)
+        start_time = time.perf_counter()
+        plain_text = pp.text_processing_pipeline(pdf_path, {})
+        plain_seconds += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        stripped_text = pp.text_processing_pipeline(pdf_path, {"extraction_setup": {"strip_header_footer": True}})
+        stripped_seconds += time.perf_counter() - start_time
+        plain_chars += len(plain_text)
+        stripped_chars += len(stripped_text)
+
+        call_date = pp.extract_call_details(plain_text, file_name, bank)["call_date"]
+        assert pp.extract_call_details(stripped_text, file_name, bank)["call_date"] == call_date, f"{file_name}: call date {call_date} lost by stripping"
+    print(f"{'extraction':<40} {plain_seconds:8.2f} s")
+    print(f"{'extraction with header/footer stripping':<40} {stripped_seconds:8.2f} s   {1 - stripped_chars / plain_chars:.1%} fewer characters")
+
+
+### MAIN FUNCTION ###
+
+BENCHMARKS = {
+    "replacements": benchmark_replacements,
+    "regex": benchmark_regex,
+    "attributions": benchmark_attributions,
+    "startup": benchmark_startup,
+    "header_footer": benchmark_header_footer,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark text processing functions on the transcript corpus')
+    parser.add_argument('benchmarks', nargs='*', help=f"Benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+
+    corpus = load_raw_corpus(get_pdf_folder())
+    print(f"Corpus: {len(corpus)} PDFs, {sum(len(text) for text in corpus.values()) / 1e6:.1f}M characters")
+
+    for name in args.benchmarks or BENCHMARKS:
+        print(f"\n{name}:")
+        BENCHMARKS[name](corpus)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,26 @@
 ### IMPORTS ###
 
-import spacy
-from spacy.matcher import Matcher
-from spacy.symbols import ORTH
+# spacy, pymupdf and anthropic are imported in the functions that use them, so that
+# --help and runs served from checkpoints or the API cache start without loading them
 import argparse
-import pymupdf
-import anthropic
+import asyncio
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import bisect
 import copy
+import hashlib
 import json
 import os
+import random
 import re
+import socket
+import socketserver
+import sqlite3
+import time
 import uuid
-from dotenv import load_dotenv
-
-load_dotenv()
+import xml.etree.ElementTree as ET
+from collections import Counter, deque
+from datetime import datetime
 
 ### 1. CONFIGURATION ###
 
@@ -69,6 +76,111 @@ def get_api_setup(config_data):
     
     return api_key_name, model, input_cost_per_million, output_cost_per_million
 
+def get_batch_setup(config_data):
+    """Extract batch processing setup from config dictionary."""
+    batch_setup = config_data.get("batch_setup", {})
+    return {
+        "max_workers": batch_setup.get("max_workers", None)
+    }
+
+def get_extraction_setup(config_data):
+    """Extract PDF text extraction setup from config dictionary."""
+    extraction_setup = config_data.get("extraction_setup", {})
+    return {
+        "page_workers": extraction_setup.get("page_workers", 1),
+        "min_pages_per_worker": extraction_setup.get("min_pages_per_worker", 8),
+        "layout_mode": extraction_setup.get("layout_mode", False),
+        "strip_header_footer": extraction_setup.get("strip_header_footer", False),
+        "header_footer_band": extraction_setup.get("header_footer_band", 0.15),
+        "min_page_fraction": extraction_setup.get("min_page_fraction", 0.5)
+    }
+
+def get_cache_setup(config_data):
+    """Extract API response cache setup from config dictionary."""
+    cache_setup = config_data.get("cache_setup", {})
+    return {
+        "enabled": cache_setup.get("enabled", False),
+        "cache_path": cache_setup.get("cache_path", "cache/api_cache.sqlite"),
+        "max_size_mb": cache_setup.get("max_size_mb", 100)
+    }
+
+def get_checkpoint_setup(config_data):
+    """Extract stage checkpoint setup from config dictionary."""
+    checkpoint_setup = config_data.get("checkpoint_setup", {})
+    return {
+        "enabled": checkpoint_setup.get("enabled", False),
+        "checkpoint_folder": checkpoint_setup.get("checkpoint_folder", "checkpoints")
+    }
+
+def get_prompt_setup(config_data):
+    """Extract prompt setup from config dictionary."""
+    prompt_setup = config_data.get("prompt_setup", {})
+    return {
+        "compress_transcript": prompt_setup.get("compress_transcript", False),
+        "window_chars": prompt_setup.get("window_chars", 200),
+        "context_pages": prompt_setup.get("context_pages", 1)
+    }
+
+def get_prompt_caching_setup(config_data):
+    """Extract prompt caching setup from the API setup in config dictionary."""
+    api_setup = config_data.get("api_setup", {})
+    return {
+        "enabled": api_setup.get("prompt_caching", True),
+        "cache_write_cost_multiplier": api_setup.get("cache_write_cost_multiplier", 1.25),
+        "cache_read_cost_multiplier": api_setup.get("cache_read_cost_multiplier", 0.1)
+    }
+
+def get_dispatch_setup(config_data):
+    """Extract concurrent API dispatch setup from config dictionary."""
+    dispatch_setup = config_data.get("dispatch_setup", {})
+    return {
+        "max_concurrency": dispatch_setup.get("max_concurrency", 8),
+        "requests_per_minute": dispatch_setup.get("requests_per_minute", 50),
+        "input_tokens_per_minute": dispatch_setup.get("input_tokens_per_minute", None),
+        "max_retries": dispatch_setup.get("max_retries", 5),
+        "initial_backoff_seconds": dispatch_setup.get("initial_backoff_seconds", 1.0)
+    }
+
+def get_message_batches_setup(config_data):
+    """Extract Message Batches API setup from config dictionary."""
+    message_batches_setup = config_data.get("message_batches_setup", {})
+    return {
+        "manifest_folder": message_batches_setup.get("manifest_folder", "message_batches"),
+        "cost_multiplier": message_batches_setup.get("cost_multiplier", 0.5)
+    }
+
+def get_registry_setup(config_data):
+    """Extract known-attribution registry setup from config dictionary."""
+    registry_setup = config_data.get("registry_setup", {})
+    return {
+        "enabled": registry_setup.get("enabled", False),
+        "registry_path": registry_setup.get("registry_path", "attribution_registry.json"),
+        "min_coverage": registry_setup.get("min_coverage", 1.0),
+        "roster_fast_path": registry_setup.get("roster_fast_path", False)
+    }
+
+def get_spacy_setup(config_data):
+    """Extract spaCy pipeline setup from config dictionary."""
+    spacy_setup = config_data.get("spacy_setup", {})
+    return {
+        "pipe_profile": spacy_setup.get("pipe_profile", "full"),
+        "chunk_chars": spacy_setup.get("chunk_chars", 0),
+        "context_chars": spacy_setup.get("context_chars", 2000),
+        "batch_size": spacy_setup.get("batch_size", 4),
+        "n_process": spacy_setup.get("n_process", 1),
+        "all_occurrences": spacy_setup.get("all_occurrences", False),
+        "doc_cache_folder": spacy_setup.get("doc_cache_folder")
+    }
+
+def get_spacy_worker_setup(config_data):
+    """Extract persistent spaCy worker setup from config dictionary."""
+    spacy_worker_setup = config_data.get("spacy_worker_setup", {})
+    return {
+        "enabled": spacy_worker_setup.get("enabled", True),
+        "socket_path": spacy_worker_setup.get("socket_path", "spacy_worker.sock"),
+        "timeout_seconds": spacy_worker_setup.get("timeout_seconds", 300)
+    }
+
 def get_cleaning_parameters(config_data):
     """Extract cleaning parameters from config dictionary."""
     cleaning_parameters = config_data.get("cleaning_parameters", {})
@@ -82,16 +194,108 @@ def get_cleaning_parameters(config_data):
 
 ### 2. PDF IMPORT AND TEXT PRE-PROCESSING ###
 
+# Dictionary of common substitutions for financial documents
+SPECIAL_CHARACTER_REPLACEMENTS = {
+    '\ufffd': '',  # replacement character
+    '\u2022': '•',  # bullet point
+    '\u2018': "'",  # left single quote
+    '\u2019': "'",  # right single quote
+    '\u201c': '"',  # left double quote
+    '\u201d': '"',  # right double quote
+    '\u2013': '-',  # en-dash
+    '\u2014': '--',  # em-dash
+    '\u00a9': '',  # copyright symbol
+}
+
+# Whitespace characters replaced by tags in add_text_tags
+WHITESPACE_TAG_REPLACEMENTS = {
+    '\u00a0': ' <NBSP> ',  # non-breaking space
+    '\f': ' <PAGEBREAK> ',  # form feed / page break
+    '\n': ' <TAG_2> ',  # line break
+    '\t': ' <TAB> ',  # tab
+}
+
+# Substitutions applied by add_text_tags
+TEXT_TAG_REPLACEMENTS = {**SPECIAL_CHARACTER_REPLACEMENTS, **WHITESPACE_TAG_REPLACEMENTS}
+
+# Apply character substitutions, skipping characters absent from the text
+def replace_characters(text, replacements):
+    # No replacement contains a replaced character, so the order of substitutions does not matter
+    for char, replacement in replacements.items():
+        if char in text:
+            text = text.replace(char, replacement)
+    return text
+
+# Precompiled patterns of the normalization functions
+TEXT_PATTERNS = {
+    # normalize_punctuation
+    "colon_no_space_after": re.compile(r':(\w)'),
+    "colon_space_before": re.compile(r'(?<=\w)\s+:'),
+    "isolated_punctuation": re.compile(r'\s+([,.;:!?])\s+'),
+    # optimize_text_tags
+    "tag_2_letter": re.compile(r'<TAG_2>\s*[A-Za-z]\s*<TAG_2>', re.IGNORECASE),
+    "tag_2_number": re.compile(r'<TAG_2>\s*(\d+)\s*<TAG_2>', re.IGNORECASE),
+    "tag_2_punctuation": re.compile(r'<TAG_2>\s*[,.;:!?-]\s*<TAG_2>', re.IGNORECASE),
+    "tag_3_letter": re.compile(r'<TAG_3>\s*[A-Za-z]\s*<TAG_3>', re.IGNORECASE),
+    "tag_3_number": re.compile(r'<TAG_3>\s*(\d+)\s*<TAG_3>', re.IGNORECASE),
+    "tag_3_punctuation": re.compile(r'<TAG_3>\s*[,.;:!?-]\s*<TAG_3>', re.IGNORECASE),
+    "tag_4_letter": re.compile(r'<TAG_4>\s*[A-Za-z]\s*<TAG_4>', re.IGNORECASE),
+    "tag_4_number": re.compile(r'<TAG_4>\s*(\d+)\s*<TAG_4>', re.IGNORECASE),
+    # Runs of the same TEXT tag (TAG_4, TAG_3 or TAG_2), replaced by the last tag of the run
+    "text_tag_run": re.compile(r'<TAG_([234])>\s*(?:<TAG_\1>\s*)*(<TAG_\1>\s*)'),
+    # optimize_word_tags
+    "bold_single_token": re.compile(r'<BOLD->\s*([:,.;?!]|[A-Za-z]|\d+)\s*<-BOLD>'),
+    "bold_adjacent": re.compile(r'<-BOLD>\s*<BOLD->'),
+    # Spaces between tags ("><" and ">  <" to "> <")
+    "tag_spacing": re.compile(r'>\s*<'),
+    "whitespace": re.compile(r'\s+'),
+    # remove_repeating_punctuation
+    "repeating_spaced_punctuation": re.compile(r'([.!?](\s+))\1{2,}'),
+    "repeating_punctuation": re.compile(r'([.!?])\1{2,}'),
+    "dot_sequence": re.compile(r'([.]\s*){2,}'),
+    # normalize_adjacent_uppercase_words
+    "operator": re.compile(r'\bOPERATOR\b'),
+    "adjacent_uppercase_words": re.compile(r'\b([A-Z][A-Z\'\-]+)(\s+[A-Z]\.?\s+)?(\s+[A-Z][A-Z\'\-]+)\b'),
+    # add_text_tags
+    "multiple_spaces": re.compile(r'[ ]{2,}'),
+    "tag_3_tag_2": re.compile(r'<TAG_3>\s*<TAG_2>'),
+    # fix_tag_spacing
+    "spaced_text_tag": re.compile(r'<\s*T\s*A\s*G\s*_\s*(\d+)\s*>'),
+    "spaced_bold_open": re.compile(r'<\s*B\s*O\s*L\s*D\s*-\s*>'),
+    "spaced_bold_close": re.compile(r'<\s*-\s*B\s*O\s*L\s*D\s*>'),
+    # process_page_text
+    "leading_punctuation": re.compile(r'^[\s!"#$%&\'*+,-./:;<=>?@[\\\]^_`{|}~]+'),
+    # clean_utterances
+    "angle_brackets": re.compile(r'<[^>]*>'),
+    "parentheses": re.compile(r'\([^)]*\)'),
+    "double_slashes": re.compile(r'//[^/]*//'),
+    "backslashes": re.compile(r'\\[^\\]*\\'),
+    # get_band_blocks (page numbers and dates of headers and footers)
+    "digits": re.compile(r'\d+'),
+}
+
+# Rules of optimize_text_tags for TEXT tags around a single character or number, in order
+TEXT_TAG_RULES = [
+    ("tag_2_letter", ' <TAG_2> '),
+    ("tag_2_number", ' <TAG_2>'),
+    ("tag_2_punctuation", ' <TAG_2>'),
+    ("tag_3_letter", ' <TAG_3> '),
+    ("tag_3_number", ' <TAG_3>'),
+    ("tag_3_punctuation", ' <TAG_3>'),
+    ("tag_4_letter", ' <TAG_4> '),
+    ("tag_4_number", ' <TAG_4> '),
+]
+
 # Move punctuation outside of bold tags and adjust colons from "word :" to "word: "
 def normalize_punctuation(text):
     """Move punctuation outside of bold tags."""
     # Manage colons
     # text = re.sub(r'(\w):', r'\1 :', text) # add space before colon
-    text = re.sub(r':(\w)', r': \1', text)  # add space after colon
-    text = re.sub(r'(\w+)\s+:', r'\1:', text)  # remove space before colon
+    text = TEXT_PATTERNS["colon_no_space_after"].sub(r': \1', text)  # add space after colon
+    text = TEXT_PATTERNS["colon_space_before"].sub(':', text)  # remove space before colon
 
     # Remove isolated punctuation marks like " : "
-    text = re.sub(r'\s+([,.;:!?])\s+', ' ', text)
+    text = TEXT_PATTERNS["isolated_punctuation"].sub(' ', text)
     
     # Strip leading/trailing whitespace
     text = text.strip()
@@ -103,23 +307,15 @@ def optimize_text_tags(text):
     """Optimize text tags by removing unnecessary formatting tags."""
 
     # Remove TEXT tags with single letter, number or punctuation (from "<TAG> [char] <TAG>" to "<TAG>")
-    text = re.sub(r'<TAG_2>\s*[A-Za-z]\s*<TAG_2>', r' <TAG_2> ', text, flags=re.IGNORECASE)
-    text = re.sub(r'<TAG_2>\s*(\d+)\s*<TAG_2>', r' <TAG_2>', text, flags=re.IGNORECASE)
-    text = re.sub(r'<TAG_2>\s*[,.;:!?-]\s*<TAG_2>', r' <TAG_2>', text, flags=re.IGNORECASE)
-    text = re.sub(r'<TAG_3>\s*[A-Za-z]\s*<TAG_3>', r' <TAG_3> ', text, flags=re.IGNORECASE)
-    text = re.sub(r'<TAG_3>\s*(\d+)\s*<TAG_3>', r' <TAG_3>', text, flags=re.IGNORECASE)
-    text = re.sub(r'<TAG_3>\s*[,.;:!?-]\s*<TAG_3>', r' <TAG_3>', text, flags=re.IGNORECASE)
-    text = re.sub(r'<TAG_4>\s*[A-Za-z]\s*<TAG_4>', r' <TAG_4> ', text, flags=re.IGNORECASE)
-    text = re.sub(r'<TAG_4>\s*(\d+)\s*<TAG_4>', r' <TAG_4> ', text, flags=re.IGNORECASE)
+    # (each rule can create new matches for the following ones, so they are applied in order)
+    for pattern_name, replacement in TEXT_TAG_RULES:
+        text = TEXT_PATTERNS[pattern_name].sub(replacement, text)
 
     # optimize multiple TEXT tags in a row, keep only one
-    text = re.sub(r'(<TAG_4>\s*){2,}', r'\1', text)
-    text = re.sub(r'(<TAG_3>\s*){2,}', r'\1', text)
-    text = re.sub(r'(<TAG_2>\s*){2,}', r'\1', text)
+    text = TEXT_PATTERNS["text_tag_run"].sub(r'\2', text)
 
     # Ensure single space between tags
-    text = re.sub(r'>\s+<', '> <', text)
-    text = re.sub(r'><', '> <', text)
+    text = TEXT_PATTERNS["tag_spacing"].sub('> <', text)
     
     return text
 
@@ -128,21 +324,18 @@ def optimize_word_tags(text):
     """Clean up text by removing unnecessary formatting tags."""
 
     # Remove WORD tags if they are around punctuation, numbers and single letters (from "<BOLD-> [char]] <-BOLD>" to "")
-    text = re.sub(r'<BOLD->\s*([:,.;?!])\s*<-BOLD>', r' \1 ', text)
-    text = re.sub(r'<BOLD->\s*([A-Za-z])\s*<-BOLD>', r' \1 ', text)
-    text = re.sub(r'<BOLD->\s*(\d+)\s*<-BOLD>', r' \1 ', text)
+    text = TEXT_PATTERNS["bold_single_token"].sub(r' \1 ', text)
     
     # Optimize multiple WORD tags
-    text = re.sub('<-BOLD>\s*<BOLD->', '', text)
+    text = TEXT_PATTERNS["bold_adjacent"].sub('', text)
     #text = re.sub('<-ITALIC>\s*<ITALIC->', '', text)
     #text = re.sub('<-UNDERLINE>\s*<UNDERLINE->', '', text)
 
     # Ensure single space between tags
-    text = re.sub(r'>\s+<', '> <', text)
-    text = re.sub(r'><', '> <', text)
+    text = TEXT_PATTERNS["tag_spacing"].sub('> <', text)
 
     # Normalize spaces
-    text = re.sub(r'\s+', ' ', text).strip()
+    text = TEXT_PATTERNS["whitespace"].sub(' ', text).strip()
     
     return text
 
@@ -181,13 +374,13 @@ def format_spaced_headers(text):
 def remove_repeating_punctuation(text):
     """Remove repeating punctuation characters."""
     # Handle cases where punctuation is separated by spaces
-    text = re.sub(r'([.!?](\s+))\1{2,}', '', text)
+    text = TEXT_PATTERNS["repeating_spaced_punctuation"].sub('', text)
     
     # Handle continuous repeating punctuation (like "............")
-    text = re.sub(r'([.!?])\1{2,}', '', text)
+    text = TEXT_PATTERNS["repeating_punctuation"].sub('', text)
     
     # Handle cases where dots are mixed with spaces in long sequences
-    text = re.sub(r'([.]\s*){2,}', '', text)
+    text = TEXT_PATTERNS["dot_sequence"].sub('', text)
     
     return text
 
@@ -195,10 +388,9 @@ def remove_repeating_punctuation(text):
 def normalize_adjacent_uppercase_words(text):
     """Convert likely names (adjacent uppercase words) to Title Case."""
     # Change "OPERATOR" to "Operator"
-    text = re.sub(r'\bOPERATOR\b', 'Operator', text)
+    text = TEXT_PATTERNS["operator"].sub('Operator', text)
 
-    # Pattern for two or more adjacent uppercase words, optionally with a middle initial
-    pattern = r'\b([A-Z][A-Z\'\-]+)(\s+[A-Z]\.?\s+)?(\s+[A-Z][A-Z\'\-]+)\b' # original
+    # Pattern for two or more adjacent uppercase words, optionally with a middle initial (TEXT_PATTERNS["adjacent_uppercase_words"])
     #pattern = r'\b([A-Z][A-Z\'\-]+)(?:\s+([A-Z]\.?)?\s+)?([A-Z][A-Z\'\-]+)\b'  # supposed to tackle apostrophes
 
     def convert_to_title(match):
@@ -207,54 +399,32 @@ def normalize_adjacent_uppercase_words(text):
         last = match.group(3).title()
         return f"{first}{middle}{last}"
     
-    return re.sub(pattern, convert_to_title, text)
+    return TEXT_PATTERNS["adjacent_uppercase_words"].sub(convert_to_title, text)
 
 # Replace special characters, add TEXT tags
 def add_text_tags(text):
     """Clean text by handling encoding issues and removing problematic characters."""
-    # Handle encoding issues with round-trip conversion
+    # Handle encoding issues: drop lone surrogates with a round trip, only if encoding fails
     try:
-        # Convert to bytes and back with explicit error handling
-        text_bytes = text.encode('utf-8', errors='ignore')
-        text = text_bytes.decode('utf-8', errors='ignore')
-    except (UnicodeError, AttributeError):
-        pass
-
-    # Dictionary of other common substitutions for financial documents
-    replacements = {
-        '�': '',
-        '\ufffd': '',
-        '\u2022': '•',  # bullet point
-        '\u2018': "'",  # left single quote
-        '\u2019': "'",  # right single quote
-        '\u201c': '"',  # left double quote
-        '\u201d': '"',  # right double quote
-        '\u2013': '-',  # en-dash
-        '\u2014': '--',  # em-dash
-        '\u00a9': '',  # copyright symbol
-        '\u00a0': ' <NBSP> ',  # non-breaking space
-        '\f': ' <PAGEBREAK> ',  # form feed / page break
-        '\n': ' <TAG_2> ',  # line break
-        '\t': ' <TAB> ',  # tab
-    }
+        text.encode('utf-8')
+    except UnicodeEncodeError:
+        text = text.encode('utf-8', errors='ignore').decode('utf-8', errors='ignore')
 
     # Apply all replacements
-    for char, replacement in replacements.items():
-        text = text.replace(char, replacement)
+    text = replace_characters(text, TEXT_TAG_REPLACEMENTS)
 
     # Preserve multiple spaces for regex pattern identification
-    text = re.sub(r'[ ]{2,}', ' <TAG_3> ', text)
+    text = TEXT_PATTERNS["multiple_spaces"].sub(' <TAG_3> ', text)
     
     # Consolidate <TAG_3> <TAG_2> into <TAG_4>
-    text = re.sub(r'<TAG_3>\s*<TAG_2>', ' <TAG_4> ', text)
+    text = TEXT_PATTERNS["tag_3_tag_2"].sub(' <TAG_4> ', text)
     # text = re.sub(r'<TAG_2> <TAG_3>', '<TAG_4>', text) # optional
 
     # Ensure single space between tags
-    text = re.sub(r'>\s+<', '> <', text)
-    text = re.sub(r'><', '> <', text)
+    text = TEXT_PATTERNS["tag_spacing"].sub('> <', text)
 
     # Normalize spaces
-    text = re.sub(r'\s+', ' ', text).strip()
+    text = TEXT_PATTERNS["whitespace"].sub(' ', text).strip()
 
     # Strip leading/trailing whitespace
     # text = text.strip()
@@ -265,82 +435,348 @@ def add_text_tags(text):
 def fix_tag_spacing(text):
     """Fix tag spacing issues that commonly occur in Q/A sections"""
     # Fix all TAG_# variations (TAG_2, TAG_3, TAG_4, etc.)
-    text = re.sub(r'<\s*T\s*A\s*G\s*_\s*(\d+)\s*>', r'<TAG_\1>', text)
+    text = TEXT_PATTERNS["spaced_text_tag"].sub(r'<TAG_\1>', text)
 
     # Fix BOLD tags
-    text = re.sub(r'<\s*B\s*O\s*L\s*D\s*-\s*>', r'<BOLD->', text)
-    text = re.sub(r'<\s*-\s*B\s*O\s*L\s*D\s*>', r'<-BOLD>', text)
+    text = TEXT_PATTERNS["spaced_bold_open"].sub('<BOLD->', text)
+    text = TEXT_PATTERNS["spaced_bold_close"].sub('<-BOLD>', text)
     return text
 
+# Tagging and normalization chain, one function at a time
+def tag_text_chain(text):
+    """Apply add_text_tags, optimize_text_tags, optimize_word_tags, format_spaced_headers and normalize_punctuation."""
+    text = add_text_tags(text)
+    text = optimize_text_tags(text)
+    text = optimize_word_tags(text)
+    text = format_spaced_headers(text)
+    return normalize_punctuation(text)
+
 # Check if a text span is a decorative marker (like large Q/A letters)
 def is_decorative_marker(span):
     """Check if a text span is a decorative marker (like large Q/A letters)."""
     # Check for characteristics of decorative Q/A markers
     is_large_text = span.get("size", 0) > 18  # Q/A markers are typically very large
     # is_special_font = "Univers-Condensed" in str(span.get("font", ""))
-    #is_single_letter = len(span.get("text", "").strip()) == 1
+    is_single_letter = len(span.get("text", "").strip()) == 1  # large titles are kept
     #is_qa_letter = span.get("text", "").strip().upper() in ["Q", "A"]
     
-    return is_large_text #and is_special_font # and is_single_letter and is_qa_letter
+    return is_large_text and is_single_letter #and is_special_font # and is_qa_letter
+
+# Font flag of bold spans in page.get_text("dict")
+SPAN_FLAG_BOLD = 16
+
+# Check if a text span is bold (by font flag or font name, e.g. "Arial-BoldMT")
+def is_bold_span(span):
+    return bool(span.get("flags", 0) & SPAN_FLAG_BOLD) or "bold" in span.get("font", "").lower()
+
+# Check if a span continues the word at the end of the previous text (e.g. "O'CONNO" + "R", "FORWARD-" + "LOOKING")
+def continues_word(previous_text, text):
+    return previous_text.rstrip("-'")[-1:].isalnum() and text.lstrip("-'")[:1].isalnum()
+
+# Control characters marking bold runs in layout mode, replaced by BOLD tags after
+# process_page_text (which strips leading punctuation such as "<" from every line)
+BOLD_MARK_REPLACEMENTS = {
+    '\x02': '<BOLD-> ',
+    '\x03': ' <-BOLD>',
+}
+
+# Read the lines of a page as lists of spans with their font
+def get_page_lines(textpage):
+    """
+    Return the text lines of a page as lists of spans (dicts with text, font, size and flags).
+
+    Spans come from the "dict" output of the page's text page. MuPDF leaves out of it the
+    characters whose glyph box is empty although they are drawn (seen in some transcripts),
+    so when the spans do not add up to the "text" output of the same text page, the lines
+    are read from its XML output instead, which keeps every character with its font name
+    and size (but no font flags, so bold is then taken from the font name only).
+    """
+    lines = [line["spans"] for block in textpage.extractDICT()["blocks"] if block["type"] == 0 for line in block["lines"]]
+    if "".join("".join(span["text"] for span in spans) + "\n" for spans in lines) == textpage.extractText():
+        return lines
+
+    lines = []
+    for line in ET.fromstring(textpage.extractXML()).iter("line"):
+        lines.append([
+            {"text": "".join(char.get("c") for char in font.iter("char")), "font": font.get("name"), "size": float(font.get("size")), "flags": 0}
+            for font in line.iter("font")
+        ])
+    return lines
+
+# Empty per-span font metrics of a page, one array per column
+def new_span_metrics():
+    """
+    Create the columnar font metrics of the spans of a page.
+
+    Span i is in line metrics["line"][i] of the page text, has metrics["chars"][i] characters,
+    font size metrics["size"][i], font flags metrics["flags"][i] and font
+    metrics["fonts"][metrics["font"][i]].
+    """
+    return {
+        "line": array('I'),
+        "chars": array('I'),
+        "size": array('f'),
+        "flags": array('I'),
+        "font": array('H'),
+        "fonts": []
+    }
+
+# Extract the text of a page span by span, with BOLD tags and font metrics
+def extract_layout_page_text(textpage):
+    """
+    Extract and clean the text of a page from its spans.
+
+    Decorative markers (large single letters such as Q/A) are dropped, bold runs are
+    surrounded by BOLD tags and the font metrics of the kept spans are recorded.
+
+    Args:
+        textpage: PyMuPDF text page of the page
+
+    Returns:
+        tuple: (page text as returned by process_page_text with BOLD tags, span metrics)
+    """
+    metrics = new_span_metrics()
+    font_index = {}
+    raw_lines = []
+
+    # Close a bold run before the trailing whitespace of its last span
+    def close_bold(parts):
+        text = parts.pop()
+        stripped = text.rstrip()
+        parts.extend([stripped, '\x03', text[len(stripped):]])
+
+    for line_num, spans in enumerate(get_page_lines(textpage)):
+        # Clean the kept spans as process_page_text cleans a whole line
+        kept_spans = []
+        texts = []
+        for span in spans:
+            if is_decorative_marker(span):
+                continue
+            text = clean_special_characters(span["text"])
+            # Leading punctuation is removed before a BOLD tag can open in front of it
+            if not any(texts):
+                text = TEXT_PATTERNS["leading_punctuation"].sub('', text)
+            kept_spans.append(span)
+            texts.append(text)
+
+            metrics["line"].append(line_num)
+            metrics["chars"].append(len(text))
+            metrics["size"].append(span["size"])
+            metrics["flags"].append(span["flags"])
+            metrics["font"].append(font_index.setdefault(span["font"], len(font_index)))
+
+        # Title case names across spans before BOLD tags are added (case changes keep the length)
+        line_text = normalize_adjacent_uppercase_words("".join(texts))
+        span_texts = []
+        offset = 0
+        for text in texts:
+            span_texts.append(line_text[offset:offset + len(text)])
+            offset += len(text)
+
+        parts = []
+        bold = False
+        for span, text in zip(kept_spans, span_texts):
+            # Spans without letters or digits (whitespace, a hyphen) do not open or close a bold run,
+            # and neither does a font change inside a word
+            if any(char.isalnum() for char in text) and is_bold_span(span) != bold and not (parts and continues_word(parts[-1], text)):
+                bold = not bold
+                if bold:
+                    parts.append('\x02')
+                else:
+                    close_bold(parts)
+            if text:
+                parts.append(text)
+        if bold:
+            close_bold(parts)
+        raw_lines.append("".join(parts))
+    metrics["fonts"] = list(font_index)
+
+    # Every line ends with a line break, as in get_text("text")
+    page_text = process_page_text("".join(line + "\n" for line in raw_lines))
+    return replace_characters(page_text, BOLD_MARK_REPLACEMENTS), metrics
 
 # Clean up after tagging
 def clean_special_characters(text):
     """Clean text by handling encoding issues and removing problematic characters."""
-    # Dictionary common substitutions
-    replacements = {
-        '�': '',
-        '\ufffd': '',
-        '\u2022': '•',  # bullet point
-        '\u2018': "'",  # left single quote
-        '\u2019': "'",  # right single quote
-        '\u201c': '"',  # left double quote
-        '\u201d': '"',  # right double quote
-        '\u2013': '-',  # en-dash
-        '\u2014': '--',  # em-dash
-        '\u00a9': '',  # copyright symbol
+    # Apply all replacements
+    return replace_characters(text, SPECIAL_CHARACTER_REPLACEMENTS)
+
+# Clean the text of one page and add line tags
+def process_page_text(page_text):
+    page_text = clean_special_characters(page_text)
+    lines = page_text.split('\n')
+    cleaned_lines = []
+    cleaned_lines_with_tags = []
+    for line in lines:
+        # Remove leading punctuation and spaces using regex
+        # ^ matches the beginning of the string
+        # [\s\p{P}]+ matches one or more spaces or punctuation characters
+        cleaned_line = TEXT_PATTERNS["leading_punctuation"].sub('', line)  # ()
+        cleaned_line = normalize_adjacent_uppercase_words(cleaned_line)
+
+        # remove lines that contain only one symbol after removing extra spaces
+        if len(cleaned_line.strip()) > 1:
+            cleaned_lines.append(cleaned_line)
+        cleaned_lines_with_tags.append(cleaned_line + "<TAG_2>")
+        
+    # Cleaning
+    # page_text = normalize_adjacent_uppercase_words(page_text)  # bring all names into title case
 
-    }
+    # Collate lines
+    return '\n'.join(cleaned_lines_with_tags)
 
-    # Apply all replacements
-    for char, replacement in replacements.items():
-        text = text.replace(char, replacement)
+# Find the text blocks of a page in its top and bottom bands (header/footer candidates)
+def get_band_blocks(textpage, page_height, band_fraction):
+    """
+    Return the non-blank text blocks of a page that lie within band_fraction of the page
+    height from its top or bottom edge.
 
-    return text
+    Each block is a dict with a key (fingerprint of its rounded vertical position and its
+    text with numbers replaced, so that page numbers and dates repeat), whether it is in the
+    top band, and the keys of its lines after process_page_text (see get_line_key).
+    """
+    band_blocks = []
+    for _, y0, _, y1, block_text, _, _ in textpage.extractBLOCKS():
+        in_top_band = y1 <= page_height * band_fraction
+        if not block_text.strip() or not (in_top_band or y0 >= page_height * (1 - band_fraction)):
+            continue
+        band_blocks.append({
+            "key": get_fingerprint(round(y0), round(y1), TEXT_PATTERNS["digits"].sub('#', block_text.strip())),
+            "top": in_top_band,
+            "lines": [get_line_key(line) for line in process_page_text(block_text.rstrip('\n')).split('\n')]
+        })
+    return band_blocks
+
+# Text of a cleaned line without tags and whitespace, to match block lines with page lines
+def get_line_key(line):
+    return "".join(TEXT_PATTERNS["angle_brackets"].sub('', line).split())
+
+# Remove the header and footer blocks that repeat on many pages
+def strip_repeating_blocks(pages, min_page_fraction):
+    """
+    Remove from the page texts the band blocks found on at least min_page_fraction of the
+    pages (and on at least 3 pages). The first page is kept whole: its title block holds the
+    bank, call date and title that extract_call_details and the prompt read from it.
+
+    A block is removed where its lines appear in the page text, searching from the top of
+    the page for header blocks and from the bottom for footer blocks; blocks whose lines
+    are not found (e.g. split into other lines by the text output) are kept.
+
+    Args:
+        pages (list): Page dicts with text and band_blocks, modified in place
+
+    Returns:
+        int: Number of lines removed
+    """
+    page_counts = Counter(key for page in pages for key in {block["key"] for block in page["band_blocks"]})
+    min_pages = max(3, len(pages) * min_page_fraction)
+    removed_count = 0
+    for page in pages[1:]:
+        lines = page["text"].split('\n')
+        line_keys = [get_line_key(line) for line in lines]
+        removed = set()
+        for block in page["band_blocks"]:
+            if page_counts[block["key"]] < min_pages:
+                continue
+            size = len(block["lines"])
+            starts = range(len(lines) - size + 1)
+            for start in (starts if block["top"] else reversed(starts)):
+                if line_keys[start:start + size] == block["lines"] and removed.isdisjoint(range(start, start + size)):
+                    removed.update(range(start, start + size))
+                    break
+        if removed:
+            page["text"] = '\n'.join(line for line_num, line in enumerate(lines) if line_num not in removed)
+            removed_count += len(removed)
+    return removed_count
+
+# Extract and clean one page
+def extract_page(page, extraction_setup):
+    """
+    Extract and clean the text of one page.
+
+    Returns:
+        dict: text, span_metrics (layout mode only, otherwise None) and band_blocks
+        (header/footer candidates, only when strip_header_footer is set)
+    """
+    import pymupdf
+    textpage = page.get_textpage(flags=pymupdf.TEXTFLAGS_TEXT)
+    if extraction_setup["layout_mode"]:
+        page_text, span_metrics = extract_layout_page_text(textpage)
+    else:
+        page_text, span_metrics = process_page_text(textpage.extractText()), None
+    band_blocks = get_band_blocks(textpage, page.rect.height, extraction_setup["header_footer_band"]) if extraction_setup["strip_header_footer"] else []
+    return {"text": page_text, "span_metrics": span_metrics, "band_blocks": band_blocks}
+
+# Extract and clean a range of pages (opens the PDF itself, so it can run in a worker process)
+def extract_page_range(pdf_path, start_page, end_page, extraction_setup):
+    import pymupdf
+    with pymupdf.open(pdf_path) as doc:
+        return [extract_page(doc.load_page(page_num), extraction_setup) for page_num in range(start_page, end_page)]
+
+# Split the pages into contiguous ranges, one per worker
+def get_page_ranges(page_count, page_workers, min_pages_per_worker):
+    workers = max(1, min(page_workers, page_count // max(1, min_pages_per_worker)))
+    bounds = [page_count * i // workers for i in range(workers + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# Separator appended to every page in the full text
+PAGE_SEPARATOR = "\n<PAGE_BREAK>\n"
+
+# Add the page numbers and the offsets of the pages in the full text
+def number_pdf_pages(pages):
+    offset = 0
+    for page_num, page in enumerate(pages):
+        page_text = page["text"]
+        numbered_page = {"page_num": page_num, "text": page_text, "start": offset, "end": offset + len(page_text)}
+        if page["span_metrics"] is not None:
+            numbered_page["span_metrics"] = page["span_metrics"]
+        yield numbered_page
+        offset += len(page_text) + len(PAGE_SEPARATOR)
+
+# Extract the cleaned pages in page order (in parallel for large documents)
+def extract_pdf_pages(pdf_path, extraction_setup):
+    import pymupdf
+    with pymupdf.open(pdf_path) as doc:
+        page_count = doc.page_count
+
+    # Large documents are split into page ranges extracted in parallel
+    page_ranges = get_page_ranges(page_count, extraction_setup["page_workers"] or os.cpu_count() or 1, extraction_setup["min_pages_per_worker"])
+    if len(page_ranges) > 1:
+        with ProcessPoolExecutor(max_workers=len(page_ranges)) as executor:
+            range_results = executor.map(extract_page_range, [pdf_path] * len(page_ranges), *zip(*page_ranges), [extraction_setup] * len(page_ranges))
+            for range_pages in range_results:
+                yield from range_pages
+    else:
+        with pymupdf.open(pdf_path) as doc:
+            for page_num in range(page_count):
+                yield extract_page(doc.load_page(page_num), extraction_setup)
+
+# Stream cleaned pages as they are extracted
+def iter_pdf_pages(pdf_path, config_data):
+    """
+    Yield the cleaned text of each page of a PDF in page order.
+
+    Each item is a dict with page_num, text and the start/end offsets of the page text
+    in the full text returned by text_processing_pipeline (pages are joined with PAGE_SEPARATOR).
+    In layout mode the text is extracted span by span (see extract_layout_page_text) and
+    the item also has the span_metrics of the page.
+    With parallel extraction, pages are yielded as soon as their page range is done.
+    With strip_header_footer, all pages are extracted first and the header and footer
+    blocks repeating across pages are removed (see strip_repeating_blocks).
+    """
+    extraction_setup = get_extraction_setup(config_data)
+    pages = extract_pdf_pages(pdf_path, extraction_setup)
+    if extraction_setup["strip_header_footer"]:
+        pages = list(pages)
+        strip_repeating_blocks(pages, extraction_setup["min_page_fraction"])
+    yield from number_pdf_pages(pages)
 
 # MAIN TEXT PROCESSING PIPELINE
 def text_processing_pipeline(pdf_path, config_data, debug_mode=False):
     """Extract text with formatting from PDF, including text from images."""
 
-    doc = pymupdf.open(pdf_path)
-    full_text = ""
-
-    for page_num in range(doc.page_count):
-        page = doc.load_page(page_num)
-        page_text = page.get_text("text")
-        page_text = clean_special_characters(page_text)
-        lines = page_text.split('\n')
-        cleaned_lines = []
-        cleaned_lines_with_tags = []
-        for line in lines:
-            # Remove leading punctuation and spaces using regex
-            # ^ matches the beginning of the string
-            # [\s\p{P}]+ matches one or more spaces or punctuation characters
-            cleaned_line = re.sub(r'^[\s!"#$%&\'*+,-./:;<=>?@[\\\]^_`{|}~]+', '', line)  # ()
-            cleaned_line = normalize_adjacent_uppercase_words(cleaned_line)
-
-            # remove lines that contain only one symbol after removing extra spaces
-            if len(cleaned_line.strip()) > 1:
-                cleaned_lines.append(cleaned_line)
-            cleaned_lines_with_tags.append(cleaned_line + "<TAG_2>")
-            
-        # Cleaning
-        # page_text = normalize_adjacent_uppercase_words(page_text)  # bring all names into title case
-
-        # Collate lines and add to full text
-        page_text = '\n'.join(cleaned_lines_with_tags)
-        full_text += page_text + "\n<PAGE_BREAK>\n"
+    full_text = "".join(page["text"] + PAGE_SEPARATOR for page in iter_pdf_pages(pdf_path, config_data))
 
-    
     # Get cleaning parameters
     #cleaning_params = get_cleaning_parameters(config_data)
     #keep_bold_tags = cleaning_params["keep_bold_tags"]
@@ -357,16 +793,16 @@ def text_processing_pipeline(pdf_path, config_data, debug_mode=False):
             f.write(full_text)
         print(f"Formatted text saved to {file_path}")
 
-    doc.close()
     return full_text
 
 
 ### 3. EXTRACTING POTENTIAL SPEAKER ATTRIBUTIONS TO ENHANCE LLM ###
 
 # Helper function to extract context around a pattern
-def extract_pattern_context(text, pattern_text, context_chars=10):
-    """Extract surrounding context for a pattern in text."""
-    pattern_pos = text.find(pattern_text)
+def extract_pattern_context(text, pattern_text, context_chars=10, pattern_pos=None):
+    """Extract surrounding context for a pattern in text (at pattern_pos if its offset is known)."""
+    if pattern_pos is None:
+        pattern_pos = text.find(pattern_text)
     if pattern_pos == -1:
         return "Not found in text"
 
@@ -375,82 +811,57 @@ def extract_pattern_context(text, pattern_text, context_chars=10):
     return text[context_start:context_end]
 
 # Helper function to format patterns with context
-def format_pattern_with_context(patterns, text):
-    """Format a list of patterns with their context into a string."""
+def format_pattern_with_context(patterns, text, all_occurrences=False):
+    """
+    Format patterns with their context into a string.
+
+    Args:
+        patterns: List of patterns, or dict of pattern occurrences from add_pattern_occurrence
+        text: Text the patterns were extracted from
+        all_occurrences: Show the context of every stored occurrence instead of only the first
+
+    Returns:
+        str: Numbered patterns, each with the text around its occurrences
+    """
     formatted_output = ""
     for i, pattern in enumerate(patterns):
         formatted_output += f"Pattern {i+1}: {pattern}\n"
-        context = extract_pattern_context(text, pattern)
-        formatted_output += f"Context: \"{context}\"\n\n"
+        if isinstance(patterns, dict):
+            pattern_starts = patterns[pattern] if all_occurrences else patterns[pattern][:1]
+        else:
+            pattern_starts = [None]  # offsets not known, search the text
+        for pattern_pos in pattern_starts:
+            context = extract_pattern_context(text, pattern, pattern_pos=pattern_pos)
+            formatted_output += f"Context: \"{context}\"\n"
+        formatted_output += "\n"
     return formatted_output
 
-# Combined function to extract all potential speaker attributions
-def extract_speaker_attributions(text, nlp, config_data=None, debug_mode=False):
-    """
-    Extract potential speaker attributions using both SpaCy NER and custom matcher.
-    Returns both a list of unique attributions and a formatted string with context.
-    """
-    # Lists to collect all patterns
-    all_patterns = []
-    ner_patterns = []
-    matcher_patterns = []
+# Record an occurrence of a pattern; the dict keeps the patterns in order of first occurrence
+def add_pattern_occurrence(patterns, pattern, start):
+    patterns.setdefault(pattern, []).append(start)
 
-    # Add custom tags to SpaCy tokenizer
-    custom_tags = ["<TAG_2>", "<TAG_3>", "<TAG_4>", "<BOLD->", "<-BOLD>"]
-    for tag in custom_tags:
-        special_case = [{ORTH: tag}]
-        nlp.tokenizer.add_special_case(tag, special_case)
-    
-    # PART 1: Extract patterns using SpaCy NER
-    doc = nlp(text)
-    potential_speakers = []
+# Formatting tags kept as single tokens by the spaCy tokenizer
+TAG_SPECIAL_CASES = ["<TAG_2>", "<TAG_3>", "<TAG_4>", "<BOLD->", "<-BOLD>"]
 
-    # Get all PERSON entities
-    for ent in doc.ents:
-        if ent.label_ == "PERSON":
-            start_char = max(0, ent.start_char - 2)
-            name = text[start_char:ent.end_char]
+# Add formatting tags as special cases of the spaCy tokenizer
+def add_tag_special_cases(nlp):
+    from spacy.symbols import ORTH
+    # Adding special cases flushes the tokenizer cache, so tags are only added once
+    tokenizer_rules = nlp.tokenizer.rules
+    for tag in TAG_SPECIAL_CASES:
+        if tag not in tokenizer_rules:
+            special_case = [{ORTH: tag}]
+            nlp.tokenizer.add_special_case(tag, special_case)
 
-            potential_speakers.append({
-                "name": name,
-                "start": start_char,
-                "end": ent.end_char
-            })
-
-    # Define tags and punctuation to look for
-    formatting_tags = ["<TAG_2>", "<TAG_3>", "<TAG_4>", "<BOLD->"]
-    punctuation_marks = [":", "-", ",", ">"]
-
-    # Process each potential speaker
-    for speaker in potential_speakers:
-        pre_context = text[max(0, speaker["start"] - 10):speaker["start"]]
-        post_context = text[speaker["end"]:min(len(text), speaker["end"] + 15)]
-
-        if any(tag in pre_context for tag in formatting_tags):
-            # Find start position (first tag)
-            start_idx = speaker["start"]
-            for tag in formatting_tags:
-                tag_pos = pre_context.rfind(tag)
-                if tag_pos != -1:
-                    start_idx = speaker["start"] - (len(pre_context) - tag_pos)
-                    break
+# Matchers built for each loaded model (keyed by the model vocab)
+_attribution_matchers = {}
 
-            # Find end position (first punctuation)
-            end_idx = speaker["end"]
-            for mark in punctuation_marks:
-                mark_pos = post_context.find(mark)
-                if mark_pos != -1:
-                    potential_end = speaker["end"] + mark_pos + 1
-                    if end_idx == speaker["end"] or potential_end < end_idx:
-                        end_idx = potential_end
-                        break
-
-            attribution = text[start_idx:end_idx]
-            if attribution and attribution not in ner_patterns:
-                ner_patterns.append(attribution)
-                all_patterns.append(attribution)
+# Build the speaker attribution matcher once per model
+def get_attribution_matcher(nlp):
+    from spacy.matcher import Matcher
+    if id(nlp.vocab) in _attribution_matchers:
+        return _attribution_matchers[id(nlp.vocab)][1]
 
-    # PART 2: Extract patterns using SpaCy matcher
     matcher = Matcher(nlp.vocab)
 
     # Pattern 1: Name and punctuation:
@@ -551,27 +962,236 @@ def extract_speaker_attributions(text, nlp, config_data=None, debug_mode=False):
         ]
     ])
     """
-    # Apply matcher
-    matches = matcher(doc)
-    for match_id, start, end in matches:
-        span = doc[start:end]
-        matched_text = span.text
-        clean_span = re.sub(r'<[^>]+>', '', matched_text).strip()
 
-        if span and matched_text not in matcher_patterns:
-            matcher_patterns.append(matched_text)
-            if matched_text not in all_patterns:
-                all_patterns.append(matched_text)
+    # The vocab is kept with the matcher so that its id is not reused
+    _attribution_matchers[id(nlp.vocab)] = (nlp.vocab, matcher)
+    return matcher
+
+# Split text into chunks of whole pages (pages longer than chunk_chars are split at line ends)
+def split_text_chunks(text, chunk_chars):
+    """
+    Split text into consecutive chunks of up to chunk_chars characters.
+
+    Returns:
+        list: (chunk, offset of the chunk in text) tuples
+    """
+    separator = PAGE_SEPARATOR.lstrip('\n')
+    pages = text.split(separator)
+    pieces = []
+    for page in [page + separator for page in pages[:-1]] + pages[-1:]:
+        pieces.extend(page.splitlines(keepends=True) if len(page) > chunk_chars else [page])
+
+    chunks = []
+    chunk_pieces = []
+    chunk_length = 0
+    offset = 0
+    for piece in pieces:
+        if chunk_pieces and chunk_length + len(piece) > chunk_chars:
+            chunks.append((''.join(chunk_pieces), offset))
+            offset += chunk_length
+            chunk_pieces, chunk_length = [], 0
+        chunk_pieces.append(piece)
+        chunk_length += len(piece)
+    if chunk_length:
+        chunks.append((''.join(chunk_pieces), offset))
+    return chunks
+
+# Process text with spaCy as one doc, or as page chunks with nlp.pipe
+def get_spacy_docs(text, nlp, config_data=None):
+    """
+    Yield (doc, offset, core_start, core_end) tuples covering the text.
+
+    offset maps doc character positions to text. With chunk_chars set (or for text longer
+    than nlp.max_length), text is split into page chunks processed with nlp.pipe using
+    batch_size and n_process. Each doc also covers up to context_chars (whole lines) of the
+    neighbouring chunks, so that entities and sentence starts near chunk edges see the same
+    context as in a single doc; only results starting in [core_start, core_end) are used.
+    """
+    spacy_setup = get_spacy_setup(config_data or {})
+    chunk_chars = spacy_setup["chunk_chars"] or (nlp.max_length // 2 if len(text) > nlp.max_length else 0)
+    if not chunk_chars:
+        yield nlp(text), 0, 0, len(text)
+        return
+
+    context_chars = spacy_setup["context_chars"]
+    windows = []
+    for chunk, core_start in split_text_chunks(text, chunk_chars):
+        core_end = core_start + len(chunk)
+        window_start = text.rfind('\n', 0, max(0, core_start - context_chars)) + 1
+        window_end = text.find('\n', min(len(text), core_end + context_chars))
+        window_end = len(text) if window_end == -1 else window_end + 1
+        windows.append((text[window_start:window_end], (window_start, core_start, core_end)))
+
+    docs = nlp.pipe(windows, as_tuples=True, batch_size=spacy_setup["batch_size"], n_process=spacy_setup["n_process"])
+    for doc, (offset, core_start, core_end) in docs:
+        yield doc, offset, core_start, core_end
+
+# Key of the cached docs of a text: changes with the text, the model, the special cases or the chunking
+def get_doc_cache_key(text, nlp, config_data=None):
+    import spacy
+    spacy_setup = get_spacy_setup(config_data or {})
+    return get_fingerprint(
+        nlp.lang, nlp.meta.get("name"), nlp.meta.get("version"), spacy.__version__, nlp.pipe_names,
+        TAG_SPECIAL_CASES, spacy_setup["chunk_chars"], spacy_setup["context_chars"], nlp.max_length, text
+    )
+
+def get_cached_spacy_docs(text, nlp, config_data=None):
+    """
+    Return the (doc, offset, core_start, core_end) tuples of get_spacy_docs, reusing docs
+    serialized with DocBin in spacy_setup.doc_cache_folder for the same text and pipeline.
+
+    Returns:
+        list: (doc, offset, core_start, core_end) tuples
+    """
+    from spacy.tokens import DocBin
+    cache_folder = get_spacy_setup(config_data or {})["doc_cache_folder"]
+    if not cache_folder:
+        return list(get_spacy_docs(text, nlp, config_data))
+
+    file_path = os.path.join(cache_folder, get_doc_cache_key(text, nlp, config_data) + ".spacy")
+    if os.path.exists(file_path):
+        try:
+            doc_bin = DocBin(store_user_data=True).from_disk(file_path)
+            return [(doc, *doc.user_data["chunk_offsets"]) for doc in doc_bin.get_docs(nlp.vocab)]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable spaCy doc cache {file_path}: {str(e)}")
+
+    docs = list(get_spacy_docs(text, nlp, config_data))
+    doc_bin = DocBin(store_user_data=True)
+    for doc, offset, core_start, core_end in docs:
+        doc.user_data["chunk_offsets"] = [offset, core_start, core_end]
+        doc_bin.add(doc)
+
+    # Write to a temporary file first so that a crash never leaves a partial cache file
+    if not os.path.exists(cache_folder):
+        os.makedirs(cache_folder, exist_ok=True)
+    temp_path = f"{file_path}.{os.getpid()}.tmp"
+    doc_bin.to_disk(temp_path)
+    os.replace(temp_path, file_path)
+    return docs
+
+# Extend a name to the preceding formatting tag and the following punctuation
+def get_tagged_attribution(text, start, end):
+    """
+    Extend a name span to a speaker attribution like "<TAG_2> Jeremy Barnum:".
+
+    Args:
+        text: Full text
+        start: Start offset of the name (including up to two preceding characters)
+        end: End offset of the name
+
+    Returns:
+        tuple: (attribution, start offset), or (None, None) if no formatting tag precedes the name
+    """
+    # Define tags and punctuation to look for
+    formatting_tags = ["<TAG_2>", "<TAG_3>", "<TAG_4>", "<BOLD->"]
+    punctuation_marks = [":", "-", ",", ">"]
+
+    pre_context = text[max(0, start - 10):start]
+    post_context = text[end:min(len(text), end + 15)]
+    if not any(tag in pre_context for tag in formatting_tags):
+        return None, None
+
+    # Find start position (first tag)
+    start_idx = start
+    for tag in formatting_tags:
+        tag_pos = pre_context.rfind(tag)
+        if tag_pos != -1:
+            start_idx = start - (len(pre_context) - tag_pos)
+            break
+
+    # Find end position (first punctuation)
+    end_idx = end
+    for mark in punctuation_marks:
+        mark_pos = post_context.find(mark)
+        if mark_pos != -1:
+            potential_end = end + mark_pos + 1
+            if end_idx == end or potential_end < end_idx:
+                end_idx = potential_end
+                break
+
+    return text[start_idx:end_idx] or None, start_idx
+
+# Collect the NER and matcher patterns of processed spaCy docs
+def collect_attribution_patterns(text, docs, matcher):
+    """
+    Collect potential speaker attributions from spaCy docs of a text.
+
+    Args:
+        text: Full text the docs were made from
+        docs: (doc, offset, core_start, core_end) tuples from get_spacy_docs
+        matcher: Attribution matcher from get_attribution_matcher
+
+    Returns:
+        tuple: (NER pattern occurrences, matcher pattern occurrences), each {pattern: [start offsets]}
+    """
+    # Occurrences of the patterns found by NER and by the matcher
+    ner_patterns = {}
+    matcher_patterns = {}
 
-    # Format results
-    ner_formatted = format_pattern_with_context(ner_patterns, text)
-    matcher_formatted = format_pattern_with_context(matcher_patterns, text)
-    combined_formatted = ner_formatted + matcher_formatted
+    # PART 1: Extract patterns using SpaCy NER
+    potential_speakers = []
+
+    # Get all PERSON entities (offsets in the full text)
+    for doc, offset, core_start, core_end in docs:
+        for ent in doc.ents:
+            if ent.label_ == "PERSON" and core_start <= offset + ent.start_char < core_end:
+                start_char = max(0, offset + ent.start_char - 2)
+                end_char = offset + ent.end_char
+                name = text[start_char:end_char]
+
+                potential_speakers.append({
+                    "name": name,
+                    "start": start_char,
+                    "end": end_char
+                })
+
+    # Extend each name to its formatting tag and punctuation
+    for speaker in potential_speakers:
+        attribution, attribution_start = get_tagged_attribution(text, speaker["start"], speaker["end"])
+        if attribution:
+            add_pattern_occurrence(ner_patterns, attribution, attribution_start)
+
+    # PART 2: Extract patterns using SpaCy matcher
+    for doc, offset, core_start, core_end in docs:
+        matches = matcher(doc)
+        for match_id, start, end in matches:
+            span = doc[start:end]
+            if not core_start <= offset + span.start_char < core_end:
+                continue
+            matched_text = span.text
+            clean_span = re.sub(r'<[^>]+>', '', matched_text).strip()
+
+            if span:
+                add_pattern_occurrence(matcher_patterns, matched_text, offset + span.start_char)
+
+    return ner_patterns, matcher_patterns
+
+# Unique patterns and their formatted context, with optional diagnostics
+def summarize_attribution_patterns(text, pattern_groups, config_data=None, debug_mode=False):
+    """
+    Combine pattern occurrences of several extraction methods.
+
+    Args:
+        text: Text the patterns were extracted from
+        pattern_groups: {method name: pattern occurrences from add_pattern_occurrence}, in output order
+        config_data: Configuration (spacy_setup.all_occurrences, diagnostics folder)
+        debug_mode: Print counts and save the formatted patterns to the diagnostics folder
+
+    Returns:
+        tuple: (list of unique attributions, formatted string with context)
+    """
+    # Unique patterns in order of discovery
+    all_patterns = list(dict.fromkeys(pattern for patterns in pattern_groups.values() for pattern in patterns))
+
+    # Format results with the context of the stored occurrences
+    all_occurrences = get_spacy_setup(config_data or {})["all_occurrences"]
+    combined_formatted = "".join(format_pattern_with_context(patterns, text, all_occurrences) for patterns in pattern_groups.values())
 
     # Debug output if requested
     if debug_mode and config_data:
-        print(f"Extracted {len(ner_patterns)} potential attributions from NER")
-        print(f"Extracted {len(matcher_patterns)} potential attributions from matcher")
+        for method, patterns in pattern_groups.items():
+            print(f"Extracted {len(patterns)} potential attributions from {method} ({sum(len(starts) for starts in patterns.values())} occurrences)")
         print(f"Combined into {len(all_patterns)} unique attributions")
 
         diagnostics_folder = get_test_mode_info(config_data)["diagnostics_folder"]
@@ -585,6 +1205,71 @@ def extract_speaker_attributions(text, nlp, config_data=None, debug_mode=False):
 
     return all_patterns, combined_formatted
 
+# Combined function to extract all potential speaker attributions
+def extract_speaker_attributions(text, nlp, config_data=None, debug_mode=False):
+    """
+    Extract potential speaker attributions using both SpaCy NER and custom matcher.
+    Returns both a list of unique attributions and a formatted string with context.
+    """
+    # Add custom tags to SpaCy tokenizer (once per model)
+    add_tag_special_cases(nlp)
+
+    docs = get_cached_spacy_docs(text, nlp, config_data)
+    ner_patterns, matcher_patterns = collect_attribution_patterns(text, docs, get_attribution_matcher(nlp))
+
+    return summarize_attribution_patterns(text, {"NER": ner_patterns, "matcher": matcher_patterns}, config_data, debug_mode)
+
+# Lexical matcher for two or three capitalized words between formatting tags (needs no tagger)
+def get_line_start_name_matcher(nlp):
+    from spacy.matcher import Matcher
+    matcher = Matcher(nlp.vocab)
+    matcher.add("TAG_NAME_TAG", [
+        [
+            {"TEXT": {"REGEX": "^<[^>]+>$"}},
+            {"IS_SPACE": True, "OP": "*"},
+            {"IS_TITLE": True, "IS_ALPHA": True, "IS_STOP": False, "LENGTH": {">": 1}},  # First name
+            {"IS_TITLE": True, "IS_STOP": False, "LENGTH": {">": 1}, "OP": "{1,2}"},     # Surname, optional initial
+            {"TEXT": {"REGEX": "^(<[^>]+>|:)$"}}
+        ]
+    ], greedy="LONGEST")
+    return matcher
+
+def extract_roster_attributions(text, nlp, roster_names, config_data=None, debug_mode=False):
+    """
+    Extract potential speaker attributions from a participant roster with a tokenizer-only pipeline.
+
+    Roster names are matched case-insensitively with a PhraseMatcher and extended to their
+    formatting tag and punctuation like PERSON entities. Capitalized words between tags are
+    suggested as well, so that speakers missing from the roster still lower the registry coverage.
+
+    Args:
+        text: Full text
+        nlp: spaCy pipeline (only its tokenizer is used)
+        roster_names: Known speaker name variants
+
+    Returns:
+        tuple: (list of unique attributions, formatted string with context)
+    """
+    from spacy.matcher import PhraseMatcher
+    add_tag_special_cases(nlp)
+    doc = nlp.tokenizer(text)
+
+    roster_matcher = PhraseMatcher(nlp.vocab, attr="LOWER")
+    roster_matcher.add("ROSTER_NAME", [nlp.tokenizer(name) for name in roster_names])
+    roster_patterns = {}
+    for match_id, start, end in roster_matcher(doc):
+        span = doc[start:end]
+        attribution, attribution_start = get_tagged_attribution(text, max(0, span.start_char - 2), span.end_char)
+        if attribution:
+            add_pattern_occurrence(roster_patterns, attribution, attribution_start)
+
+    line_start_patterns = {}
+    for match_id, start, end in get_line_start_name_matcher(nlp)(doc):
+        span = doc[start:end]
+        add_pattern_occurrence(line_start_patterns, span.text, span.start_char)
+
+    return summarize_attribution_patterns(text, {"roster": roster_patterns, "line-start names": line_start_patterns}, config_data, debug_mode)
+
 # Extract potential attributions for "Operator" with preceeding formatting tags
 def get_operator_attributions(text):
     operator_pattern = r'(<[^>]+>)+\s*Operator'
@@ -602,18 +1287,328 @@ def get_operator_attributions(text):
 
 ### 4. SPEAKER ATTRIBUTION EXTRACTION USING LLM ###
 
-# API call to extract speaker attributions
-def API_call(text, spacy_patterns, operator_attributions, config_data, debug_mode=False):
-    # Construct the prompt according to the specified format
-    prompt = f"""User: You are an AI assistant specialized in extracting speaker attributions from earning call transcripts.
+# Bump when the prompt in API_call changes so that cached responses are not reused
+API_PROMPT_VERSION = 2
+
+# Rough token estimate used to report prompt compression (about 4 characters per token)
+def estimate_tokens(text):
+    return len(text) // 4
+
+# Build a compact transcript with only the lines that may contain speaker attributions
+def build_compressed_transcript(text, potential_attributions, window_chars=200, context_pages=1):
+    """
+    Build a compact version of the transcript for the API prompt.
+
+    Keeps the first and last context_pages pages in full (call details, last utterance,
+    header and footer) and, in between, a window of up to window_chars characters from
+    the start of every line that contains a spaCy suggestion or "Operator", followed by
+    the start of the next line (job titles and companies are often on the next line).
+    Omitted text is replaced with "[...]".
+
+    Args:
+        text (str): Full transcript text
+        potential_attributions (list): Attributions suggested by spaCy (substrings of text)
+        window_chars (int): Number of characters to keep from the start of each line
+        context_pages (int): Number of pages to keep in full at the start and at the end
+
+    Returns:
+        str: Compressed transcript
+    """
+    # Page boundaries (pages keep their trailing <PAGE_BREAK> tag)
+    page_ends = [match.end() for match in re.finditer(r'<PAGE_BREAK>\s*', text)]
+    if len(page_ends) <= 2 * context_pages:
+        return text
+    head_end = page_ends[context_pages - 1] if context_pages else 0
+    tail_start = page_ends[-context_pages - 1] if context_pages else len(text)
+
+    # Line boundaries are the line and paragraph break tags
+    line_starts = [0] + [match.end() for match in re.finditer(r'<TAG_[24]>\s*|<PAGE_BREAK>\s*', text)]
+    line_ends = line_starts[1:] + [len(text)]
+
+    # Locate all suggestions in one pass and mark the lines they touch
+    candidates = [{"speaker_name": None, "attribution": pattern} for pattern in potential_attributions if pattern]
+    candidates.append({"speaker_name": None, "attribution": "Operator"})
+    window_ends = {}
+    for match in find_attribution_matches(text, build_attribution_automaton(candidates)):
+        if match["end"] <= head_end or match["start"] >= tail_start:
+            continue
+        first_line = bisect.bisect_right(line_starts, match["start"]) - 1
+        last_line = bisect.bisect_right(line_starts, match["end"] - 1) - 1
+        for line_index in range(first_line, min(last_line + 2, len(line_starts))):
+            # The whole match is always kept, the rest of the line up to window_chars
+            window_end = max(line_starts[line_index] + window_chars, match["end"] if line_index <= last_line else 0)
+            window_ends[line_index] = max(window_ends.get(line_index, 0), min(line_ends[line_index], window_end))
+
+    # Collate head, line windows and tail, marking every gap
+    parts = [text[:head_end]]
+    last_end = head_end
+    for line_index in sorted(window_ends):
+        start = max(line_starts[line_index], last_end)
+        end = min(window_ends[line_index], tail_start)
+        if end <= start:
+            continue
+        if start > last_end:
+            parts.append(" [...]\n")
+        parts.append(text[start:end])
+        last_end = end
+    if tail_start > last_end:
+        parts.append(" [...]\n")
+    parts.append(text[max(tail_start, last_end):])
+
+    return "".join(parts)
+
+# Cache key for the API response: hash of the normalized prompt inputs
+def get_api_cache_key(text, spacy_patterns, operator_attributions, model, prompt_setup=None):
+    """Return a SHA-256 key for the prompt inputs of an API call."""
+    # Normalize line endings and trailing whitespace of the transcript
+    normalized_text = '\n'.join(line.rstrip() for line in text.strip().splitlines())
+
+    # Operator suggestions come from a set, so their order is not stable between runs
+    if isinstance(operator_attributions, (list, tuple, set)):
+        operator_attributions = sorted(operator_attributions)
+
+    key_data = {
+        "prompt_version": API_PROMPT_VERSION,
+        "model": model,
+        "full_text": normalized_text,
+        "spacy_patterns": spacy_patterns,
+        "operator_attributions": operator_attributions,
+        "prompt_setup": prompt_setup
+    }
+    key_json = json.dumps(key_data, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(key_json.encode('utf-8')).hexdigest()
+
+# Open the SQLite cache, creating the table if needed
+def open_api_cache(cache_path):
+    cache_folder = os.path.dirname(cache_path)
+    if cache_folder and not os.path.exists(cache_folder):
+        os.makedirs(cache_folder)
+        print(f"Created directory: {cache_folder}")
+
+    connection = sqlite3.connect(cache_path)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS api_cache ("
+        "key TEXT PRIMARY KEY, model TEXT, response TEXT, size_bytes INTEGER, "
+        "created_at REAL, last_access REAL)"
+    )
+    return connection
+
+def load_cached_api_response(cache_path, key):
+    """Return the cached API response for the key or None, and mark it as recently used."""
+    if not os.path.exists(cache_path):
+        return None
+
+    connection = open_api_cache(cache_path)
+    try:
+        row = connection.execute("SELECT response FROM api_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        connection.execute("UPDATE api_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+        connection.commit()
+        return json.loads(row[0])
+    finally:
+        connection.close()
+
+def save_cached_api_response(cache_path, key, model, api_response, max_size_mb):
+    """Store an API response and evict least recently used entries above max_size_mb."""
+    response_json = json.dumps(api_response, ensure_ascii=False)
+    now = time.time()
+
+    connection = open_api_cache(cache_path)
+    try:
+        connection.execute(
+            "INSERT OR REPLACE INTO api_cache (key, model, response, size_bytes, created_at, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, response_json, len(response_json.encode('utf-8')), now, now)
+        )
+
+        # LRU eviction: keep the most recently used entries that fit into the size limit
+        max_bytes = max_size_mb * 1024 * 1024
+        total_bytes = 0
+        evicted_keys = []
+        for row_key, size_bytes in connection.execute(
+            "SELECT key, size_bytes FROM api_cache ORDER BY last_access DESC"
+        ).fetchall():
+            total_bytes += size_bytes
+            if total_bytes > max_bytes and row_key != key:
+                evicted_keys.append((row_key,))
+        connection.executemany("DELETE FROM api_cache WHERE key = ?", evicted_keys)
+        connection.commit()
+    finally:
+        connection.close()
+
+# Static instruction block of the prompt. It is sent first and marked for prompt caching,
+# so it is only billed at the full input price once per cache lifetime.
+API_INSTRUCTIONS = """You are an AI assistant specialized in extracting speaker attributions from earning call transcripts.
+
+<goal>
+Extract all speaker attributions and call details from the transcript.    
+</goal>
+
+<instructions>
+Follow these step by step instructions:
+Step 1: Find the names of all call participants, including variations and misspellings. Use the spacy suggestions to help you.
+Step 2: For each participant, find their job title and companies, including variations.
+Step 3: Go through the whole text in small overlapping chunks to idenitify all variants of speaker attributions including leading and tailing tags, names, titles and companies (if available), punctuation marks.
+Step 4. For each speaker with a single attribution check again for other attributions with different formatting.
+Step 5. Identify call details like bank name, call date and reporting period.
+Step 6. Identify the last 10 tokens of the last utterance in the transcript.
+Step 7. Identify header and footer that repeat throughout the transcript, if any.
+Step 8. Return results as a json object.
+</instructions>
+
+<formatting_tags>
+Formatting tags should be treated as text and should be added to the attribution.
+- Bold text is surrounded by <BOLD-> [speaker attribution or text or punctuation] <-BOLD>
+- Line breaks are marked as <TAG_2>
+- Paragraph breaks are marked as <TAG_4>
+- Multispaces are marked as <TAG_3>
+- Page breaks are marked as <PAGE_BREAK>
+</formatting_tags>
+
+<attribution_description>
+The speaker attribution :
+1. There are usually two or more variants of the attribution formats for the same speaker. Always include all variants in the output.
+2. Attribution must start on a new line.
+3. Attribution may be on the same line as the speaker's speech or on the next line.
+4. Attribution includes one of the following:
+    a) [Speaker Name and Surname] or [Name, Middle Name Initial and Surname]
+    b) [Speaker Name and Surname] or [Name, Middle Name Initial and Surname], followed by a [job title], [company], or [job title and company]
+5. The job title and company, if present, can be separated from the speaker name and from each other by a punctuation mark like a colon or a dash, a formatting tag like <BOLD-> or <TAG_2> or <TAG_2>, or a combination.
+6. Attribution must end with a punctuation mark like a colon or a dash, a formatting tag like <-BOLD> or <TAG_2>, or both.
+6. Attribution never includes the text of the speech of the speaker.
+</attribution_description>
+
+<attribution_search_guidelines>
+Guidelines for searching for speaker attribution:
+- Always check the whole transcript from the beginning to the end.
+- Always look for attributions everywhere in paragraphs, both at the beginning, middle and at the end of paragraphs, particularly after sentence endings.
+- Always include all variations of attributions for each speaker even if the difference is in one character.   
+- Pay attention to the job title and company name variations.
+- Speaker attributions always alternate with the speaker's speech.
+- Speaker attributions cannot appear next to each other. If they do, they are not speaker attributions. There should always be a speech between attributions.
+- If two adjacent speeches are from the same speaker, then there must be an attribution for another speaker between them. Find it.
+- All variants of operator attibutions should always contain the word "Operator" and variations of leading and trailing formatting tags.
+- Always include ALL attributions variants even if minor.
+
+Additionally:
+- If speaker's name is separated from the job title or company by a text segment that is not a formatting tag, then only speaker name should be a part of attribution.
+- If speaker's name is followed by a text segment that is not a formatting tag, then only speaker name should be a part of attribution.
+</attribution_search_guidelines>
+
+<examples>    
+Examples of attributions that contain speaker name only:
+* "(attribution starts) Full name <TAG_2> (attribution ends) (new line) Thank you. I'd like to present our quarterly results."
+* "(attribution starts) Full name - (attribution ends) (same line) Thank you. I'd like to present our quarterly results."
+* "(attribution starts) Full name: <TAG_2>(attribution ends) (new line) Thank you. I'd like to present our quarterly results."
+* "(attribution starts) Full name: (attribution ends) (same line) Thank you. I'd like to present our quarterly results."
+If the same speaker has various attributions, then all attributions should be included into the output.
+
+Examples of attributions that contain speaker name with job title, company, or job title and company:
+* "(attribution starts) Full name - Company - Job Title (attribution ends) (new line) Thank you. I'd like to present our quarterly results."
+* "(attribution starts) Full name - Company - Job Title (attribution ends) (same line) Thank you. I'd like to present our quarterly results."
+* "(attribution starts) Full name - CEO, TechCorp: (attribution ends) (new line) Thank you. I'd like to present our quarterly results."
+* "(attribution starts) Full name, CFO: (attribution ends) (same line) Thank you. I'd like to present our quarterly results."
+* "(attribution starts) Full name • Senior VP: (attribution ends) (new line) Thank you. I'd like to present our quarterly results."
+* "(attribution starts) Full name • Senior VP: (attribution ends) (same line) Thank you. I'd like to present our quarterly results."
+
+Example of complex attributions with multiple tags and punctuation:
+* "(attribution starts) Jamie Dimon <TAG_3> <TAG_2> Chairman & Chief Executive Officer, JPMorgan Chase & Co. <TAG_3><TAG_2> (attribution ends)"
+
+There are often multiple attribution formatting variations of the same speaker, for example:
+* "(attribution starts) Full name: (attribution ends) Thank you. I'd like to present our quarterly results."
+* "(attribution starts) Full name <TAG_2> (attribution ends) Thank you. I'd like to present our quarterly results."
+In such cases all variants should be included in the output.
+
+There are often multiple variations of the Operator attributions, for example:
+* "OPERATOR:"
+* "OPERATOR <TAG_2>"
+In such cases all variants should be included in the output.
+
+Spelling and Name Variations:
+* "(attribution begins here) Michael J. Thompson: (attribution ends here)"
+* "(attribution begins here)  Mike Thompson: (attribution ends here)"
+In such cases all variants should be included in the output.
+
+Job Title and Company Separation:
+* "(attribution begins here) Full name: <TAG_2> (attribution ends here) Thank you. I am (Job Title) and I'd like present our (Company Name) quarterly results."
+In such cases only "<TAG_4> Full name: <TAG_2>" should be considered attribution because there is a text between the name and job title.
+
+Company Name Variations:
+* "(attribution begins here) Full name <TAG_2> (Full company name) <TAG_2> (attribution ends here) Thank you. I'd like to present our quarterly results."
+* "(attribution begins here) Full name <TAG_2> (Company name abbreviation) <TAG_2> (attribution ends here) Thank you. I'd like to present our quarterly results."
+In such cases all variants should be included in the output.
+</examples>
+
+REMEMBER: The output should include ALL variants of the attributions for every speaker.
+
+Here's an example of the expected JSON structure (with generic placeholders):
+<jsonexample>
+{
+"bank_name": "Example Bank",
+"call_date": "YYYY-MM-DD",
+"reporting_period": "Q-YYYY",
+"header_pattern": "HEADER_PATTERN",
+"footer_pattern": "FOOTER_PATTERN",
+"last_utterance_tokens": "LAST_10_TOKENS",
+"participants": [
+    {
+    "speaker_name_variants": ["John Doe", "Jon Doe", "John Do"],
+    "speaker_title_variants": ["Chief Executive Officer", "CEO"],
+    "speaker_company_variants": ["Example Bank", "Example Bank Inc.", "EB"],
+    "speaker_attributions": ["<TAG_2> JOHN DOE:", "<BOLD-> John Doe - CEO - Example Bank <-BOLD>", "John Doe - EB - CEO <TAG_3>"]
+    }
+]
+}
+</jsonexample>
+
+<json_validation>
+Your response must be valid, parseable JSON. Ensure:
+- Use single curly braces for objects, not double
+- All strings are properly quoted
+- No trailing commas in arrays or objects
+- All keys and values follow proper JSON syntax
+- Test your JSON structure mentally before providing it as output
+</json_validation>
+
+It should be possible to parse the JSON object from the response.
+Provide only the JSON object as your final response, with no additional text or explanations.
+"""
 
-    <goal>
-    Extract all speaker attributions and call details from the transcript.    
-    </goal>
+# Build the parameters of the messages API request
+def build_api_request(text, spacy_patterns, operator_attributions, config_data):
+    """
+    Build the messages API request for a transcript.
+
+    The static instructions go first as a system block marked with cache_control,
+    followed by the variable transcript and suggestions in the user message.
+
+    Returns:
+        tuple: (request parameters for messages.create, prompt compression stats or None)
+    """
+    # Optionally send only the lines that may contain speaker attributions
+    prompt_setup = get_prompt_setup(config_data)
+    transcript_intro = "Here is the transcript to analyze:"
+    transcript_text = text
+    prompt_compression = None
+    if prompt_setup["compress_transcript"]:
+        transcript_intro = ("Here are excerpts of the transcript to analyze: the first and last pages in full, "
+                            "and the start of every line that may contain a speaker attribution. Omitted text is marked with [...].")
+        transcript_text = build_compressed_transcript(text, spacy_patterns[0], prompt_setup["window_chars"], prompt_setup["context_pages"])
+        original_tokens = estimate_tokens(text)
+        compressed_tokens = estimate_tokens(transcript_text)
+        prompt_compression = {
+            "original_tokens_estimate": original_tokens,
+            "compressed_tokens_estimate": compressed_tokens,
+            "reduction_ratio": original_tokens / compressed_tokens if compressed_tokens else 0
+        }
+        print(f"Compressed transcript from ~{original_tokens} to ~{compressed_tokens} tokens "
+              f"({prompt_compression['reduction_ratio']:.1f}x reduction)")
 
-    Here is the transcript to analyze:
+    # Construct the prompt according to the specified format
+    prompt = f"""{transcript_intro}
     <transcript>
-    {text}
+    {transcript_text}
     </transcript>
 
     Here are the potential speaker attributions extracted by SpaCy:
@@ -626,233 +1621,290 @@ def API_call(text, spacy_patterns, operator_attributions, config_data, debug_mod
     {operator_attributions}
     </operator_suggestions>
 
-    <instructions>
-    Follow these step by step instructions:
-    Step 1: Find the names of all call participants, including variations and misspellings. Use the spacy suggestions to help you.
-    Step 2: For each participant, find their job title and companies, including variations.
-    Step 3: Go through the whole text in small overlapping chunks to idenitify all variants of speaker attributions including leading and tailing tags, names, titles and companies (if available), punctuation marks.
-    Step 4. For each speaker with a single attribution check again for other attributions with different formatting.
-    Step 5. Identify call details like bank name, call date and reporting period.
-    Step 6. Identify the last 10 tokens of the last utterance in the transcript.
-    Step 7. Identify header and footer that repeat throughout the transcript, if any.
-    Step 8. Return results as a json object.
-    </instructions>
-
-    <formatting_tags>
-    Formatting tags should be treated as text and should be added to the attribution.
-    - Bold text is surrounded by <BOLD-> [speaker attribution or text or punctuation] <-BOLD>
-    - Line breaks are marked as <TAG_2>
-    - Paragraph breaks are marked as <TAG_4>
-    - Multispaces are marked as <TAG_3>
-    - Page breaks are marked as <PAGE_BREAK>
-    </formatting_tags>
-
-    <attribution_description>
-    The speaker attribution :
-    1. There are usually two or more variants of the attribution formats for the same speaker. Always include all variants in the output.
-    2. Attribution must start on a new line.
-    3. Attribution may be on the same line as the speaker's speech or on the next line.
-    4. Attribution includes one of the following:
-        a) [Speaker Name and Surname] or [Name, Middle Name Initial and Surname]
-        b) [Speaker Name and Surname] or [Name, Middle Name Initial and Surname], followed by a [job title], [company], or [job title and company]
-    5. The job title and company, if present, can be separated from the speaker name and from each other by a punctuation mark like a colon or a dash, a formatting tag like <BOLD-> or <TAG_2> or <TAG_2>, or a combination.
-    6. Attribution must end with a punctuation mark like a colon or a dash, a formatting tag like <-BOLD> or <TAG_2>, or both.
-    6. Attribution never includes the text of the speech of the speaker.
-    </attribution_description>
-    
-    <attribution_search_guidelines>
-    Guidelines for searching for speaker attribution:
-    - Always check the whole transcript from the beginning to the end.
-    - Always look for attributions everywhere in paragraphs, both at the beginning, middle and at the end of paragraphs, particularly after sentence endings.
-    - Always include all variations of attributions for each speaker even if the difference is in one character.   
-    - Pay attention to the job title and company name variations.
-    - Speaker attributions always alternate with the speaker's speech.
-    - Speaker attributions cannot appear next to each other. If they do, they are not speaker attributions. There should always be a speech between attributions.
-    - If two adjacent speeches are from the same speaker, then there must be an attribution for another speaker between them. Find it.
-    - All variants of operator attibutions should always contain the word "Operator" and variations of leading and trailing formatting tags.
-    - Always include ALL attributions variants even if minor.
-    
-    Additionally:
-    - If speaker's name is separated from the job title or company by a text segment that is not a formatting tag, then only speaker name should be a part of attribution.
-    - If speaker's name is followed by a text segment that is not a formatting tag, then only speaker name should be a part of attribution.
-    </attribution_search_guidelines>
-    
-    <examples>    
-    Examples of attributions that contain speaker name only:
-    * "(attribution starts) Full name <TAG_2> (attribution ends) (new line) Thank you. I'd like to present our quarterly results."
-    * "(attribution starts) Full name - (attribution ends) (same line) Thank you. I'd like to present our quarterly results."
-    * "(attribution starts) Full name: <TAG_2>(attribution ends) (new line) Thank you. I'd like to present our quarterly results."
-    * "(attribution starts) Full name: (attribution ends) (same line) Thank you. I'd like to present our quarterly results."
-    If the same speaker has various attributions, then all attributions should be included into the output.
-
-    Examples of attributions that contain speaker name with job title, company, or job title and company:
-    * "(attribution starts) Full name - Company - Job Title (attribution ends) (new line) Thank you. I'd like to present our quarterly results."
-    * "(attribution starts) Full name - Company - Job Title (attribution ends) (same line) Thank you. I'd like to present our quarterly results."
-    * "(attribution starts) Full name - CEO, TechCorp: (attribution ends) (new line) Thank you. I'd like to present our quarterly results."
-    * "(attribution starts) Full name, CFO: (attribution ends) (same line) Thank you. I'd like to present our quarterly results."
-    * "(attribution starts) Full name • Senior VP: (attribution ends) (new line) Thank you. I'd like to present our quarterly results."
-    * "(attribution starts) Full name • Senior VP: (attribution ends) (same line) Thank you. I'd like to present our quarterly results."
-
-    Example of complex attributions with multiple tags and punctuation:
-    * "(attribution starts) Jamie Dimon <TAG_3> <TAG_2> Chairman & Chief Executive Officer, JPMorgan Chase & Co. <TAG_3><TAG_2> (attribution ends)"
-    
-    There are often multiple attribution formatting variations of the same speaker, for example:
-    * "(attribution starts) Full name: (attribution ends) Thank you. I'd like to present our quarterly results."
-    * "(attribution starts) Full name <TAG_2> (attribution ends) Thank you. I'd like to present our quarterly results."
-    In such cases all variants should be included in the output.
-
-    There are often multiple variations of the Operator attributions, for example:
-    * "OPERATOR:"
-    * "OPERATOR <TAG_2>"
-    In such cases all variants should be included in the output.
-    
-    Spelling and Name Variations:
-    * "(attribution begins here) Michael J. Thompson: (attribution ends here)"
-    * "(attribution begins here)  Mike Thompson: (attribution ends here)"
-    In such cases all variants should be included in the output.
-    
-    Job Title and Company Separation:
-    * "(attribution begins here) Full name: <TAG_2> (attribution ends here) Thank you. I am (Job Title) and I'd like present our (Company Name) quarterly results."
-    In such cases only "<TAG_4> Full name: <TAG_2>" should be considered attribution because there is a text between the name and job title.
-    
-    Company Name Variations:
-    * "(attribution begins here) Full name <TAG_2> (Full company name) <TAG_2> (attribution ends here) Thank you. I'd like to present our quarterly results."
-    * "(attribution begins here) Full name <TAG_2> (Company name abbreviation) <TAG_2> (attribution ends here) Thank you. I'd like to present our quarterly results."
-    In such cases all variants should be included in the output.
-    </examples>
-
-    REMEMBER: The output should include ALL variants of the attributions for every speaker.
-    
-    Here's an example of the expected JSON structure (with generic placeholders):
-    <jsonexample>
-    {{
-    "bank_name": "Example Bank",
-    "call_date": "YYYY-MM-DD",
-    "reporting_period": "Q-YYYY",
-    "header_pattern": "HEADER_PATTERN",
-    "footer_pattern": "FOOTER_PATTERN",
-    "last_utterance_tokens": "LAST_10_TOKENS",
-    "participants": [
-        {{
-        "speaker_name_variants": ["John Doe", "Jon Doe", "John Do"],
-        "speaker_title_variants": ["Chief Executive Officer", "CEO"],
-        "speaker_company_variants": ["Example Bank", "Example Bank Inc.", "EB"],
-        "speaker_attributions": ["<TAG_2> JOHN DOE:", "<BOLD-> John Doe - CEO - Example Bank <-BOLD>", "John Doe - EB - CEO <TAG_3>"]
-        }}
-    ]
-    }}
-    </jsonexample>
+    Follow the instructions and provide only the JSON object as your final response.
+    """
+    model = get_api_setup(config_data)[1] or "claude-3-7-sonnet-20250219"  # claude-3-opus-20240229 claude-3-7-sonnet-20250219
+
+    # Mark the static instruction block for prompt caching
+    instructions_block = {"type": "text", "text": API_INSTRUCTIONS}
+    if get_prompt_caching_setup(config_data)["enabled"]:
+        instructions_block["cache_control"] = {"type": "ephemeral"}
+
+    request_params = {
+        "model": model,
+        "max_tokens": 4096,
+        "system": [
+            {"type": "text", "text": "You are an expert in finding speaker attributions in the earnings call transcripts."},
+            instructions_block
+        ],
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 0,
+        "top_p": 0.7,
+        # "top_k": 20
+    }
+    return request_params, prompt_compression
+
+# Create the keyword arguments for the Anthropic clients
+def get_client_kwargs(config_data):
+    """Return API key and optional base URL (e.g. a local stand-in server) for the API client."""
+    from dotenv import load_dotenv
+    load_dotenv()  # API key from the .env file
+    api_key_name = get_api_setup(config_data)[0]
+    client_kwargs = {"api_key": os.getenv(api_key_name) if api_key_name else None}
+    base_url = config_data.get("api_setup", {}).get("base_url")
+    if base_url:
+        client_kwargs["base_url"] = base_url
+    return client_kwargs
+
+# Look up the response cache before calling the API
+def lookup_cached_api_response(text, spacy_patterns, operator_attributions, config_data, use_cache=True):
+    """
+    Return the cached response for the prompt inputs (or None) and the cache key
+    to store a new response under (None if the cache is not used).
+    """
+    cache_setup = get_cache_setup(config_data)
+    if not (use_cache and cache_setup["enabled"]):
+        return None, None
+
+    model = get_api_setup(config_data)[1] or "claude-3-7-sonnet-20250219"
+    cache_key = get_api_cache_key(text, spacy_patterns, operator_attributions, model, get_prompt_setup(config_data))
+    cached_response = load_cached_api_response(cache_setup["cache_path"], cache_key)
+    if cached_response is not None:
+        print("Using cached API response.")
+        cached_response["cache_hit"] = True
+    return cached_response, cache_key
+
+# Store a parsed API response in the response cache
+def store_cached_api_response(cache_key, api_response, config_data):
+    # Only cache responses that could be parsed
+    if cache_key is None or not api_response.get("json_parsed_successfully"):
+        return
+    cache_setup = get_cache_setup(config_data)
+    model = get_api_setup(config_data)[1] or "claude-3-7-sonnet-20250219"
+    save_cached_api_response(cache_setup["cache_path"], cache_key, model, api_response, cache_setup["max_size_mb"])
 
-    <json_validation>
-    Your response must be valid, parseable JSON. Ensure:
-    - Use single curly braces for objects, not double
-    - All strings are properly quoted
-    - No trailing commas in arrays or objects
-    - All keys and values follow proper JSON syntax
-    - Test your JSON structure mentally before providing it as output
-    </json_validation>
+# Turn an API message into the response dictionary used by the pipeline
+def parse_api_message(message, config_data, debug_mode=False, prompt_compression=None):
+    """
+    Calculate token counts and cost of an API message and parse its JSON content.
 
-    It should be possible to parse the JSON object from the response.
-    Provide only the JSON object as your final response, with no additional text or explanations.
+    Returns:
+        dict: Response text, parsed JSON, token counts and cost estimate (or "error")
     """
-    api_key_name, model, input_cost_per_million, output_cost_per_million = get_api_setup(config_data)
-    api_key = os.getenv(api_key_name)
-    client = anthropic.Anthropic(api_key=api_key)
+    # Get token counts from the API response and calculate cost
+    # input_tokens excludes the tokens written to or read from the prompt cache
+    _, _, input_cost_per_million, output_cost_per_million = get_api_setup(config_data)
+    prompt_caching_setup = get_prompt_caching_setup(config_data)
+    input_tokens = message.usage.input_tokens
+    cache_creation_input_tokens = getattr(message.usage, "cache_creation_input_tokens", 0) or 0
+    cache_read_input_tokens = getattr(message.usage, "cache_read_input_tokens", 0) or 0
+    output_tokens = message.usage.output_tokens
+    total_tokens = input_tokens + cache_creation_input_tokens + cache_read_input_tokens + output_tokens
+
+    input_cost = (input_tokens / 1_000_000) * float(input_cost_per_million)
+    cache_write_cost = (cache_creation_input_tokens / 1_000_000) * float(input_cost_per_million) * prompt_caching_setup["cache_write_cost_multiplier"]
+    cache_read_cost = (cache_read_input_tokens / 1_000_000) * float(input_cost_per_million) * prompt_caching_setup["cache_read_cost_multiplier"]
+    output_cost = (output_tokens / 1_000_000) * float(output_cost_per_million)
+    total_cost = input_cost + cache_write_cost + cache_read_cost + output_cost
+
+    # Get the response text
+    if not message.content or len(message.content) == 0:
+        return {
+            "error": "Empty response from API"
+        }
 
-    if debug_mode:
-        print(f"Running API call using {model}...")
+    response_text = message.content[0].text
 
-    try:
-        message = client.messages.create(
-            model="claude-3-7-sonnet-20250219",  # claude-3-opus-20240229 claude-3-7-sonnet-20250219
-            max_tokens=4096,
-            system="You are an expert in finding speaker attributions in the earnings call transcripts.",
-            messages=[
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0,
-            top_p=0.7,
-            # top_k=20
-        )
+    diagnostics_folder = get_test_mode_info(config_data)["diagnostics_folder"]  # always use this folder for diagnostics
 
-        # Get token counts from the API response and calculate cost
-        input_tokens = message.usage.input_tokens
-        output_tokens = message.usage.output_tokens
-        total_tokens = input_tokens + output_tokens
+    # Always save the raw response for debugging
+    if debug_mode:
+        raw_response_path = os.path.join(diagnostics_folder, 'api_response_raw.txt')
+        with open(raw_response_path, 'w', encoding='utf-8') as f:
+            f.write(response_text)
+        print(f"Raw API response saved to {raw_response_path}")
 
-        input_cost = (input_tokens / 1_000_000) * float(input_cost_per_million)
-        output_cost = (output_tokens / 1_000_000) * float(output_cost_per_million)
-        total_cost = input_cost + output_cost
+    # Try to parse the response as JSON
+    try:
+        # Check if the response is wrapped in markdown code blocks
+        clean_response = response_text
+        if response_text.startswith("```json"):
+            end_marker = "```"
+            end_pos = response_text.rfind(end_marker)
+            if end_pos > 0:
+                clean_response = response_text[7:end_pos].strip()
+
+                if debug_mode:
+                    cleaned_path = os.path.join(diagnostics_folder, 'api_response_cleaned.txt')
+                    with open(cleaned_path, 'w', encoding='utf-8') as f:
+                        f.write(clean_response)
+                    print(f"Cleaned API response saved to {cleaned_path}")
+
+        json_response = json.loads(clean_response)
+        parsed_successfully = True
 
-        # Get the response text
-        if not message.content or len(message.content) == 0:
-            return {
-                "error": "Empty response from API"
-            }
+        if debug_mode:
+            parsed_path = os.path.join(diagnostics_folder, 'api_response_parsed.json')
+            with open(parsed_path, 'w', encoding='utf-8') as f:
+                json.dump(json_response, f, indent=2)
+            print(f"Parsed JSON saved to {parsed_path}")
 
-        response_text = message.content[0].text
+    except json.JSONDecodeError as e:
+        parsed_successfully = False
+        json_response = None
 
-        diagnostics_folder = get_test_mode_info(config_data)["diagnostics_folder"]  # always use this folder for diagnostics
-        
-        # Always save the raw response for debugging
         if debug_mode:
-            raw_response_path = os.path.join(diagnostics_folder, 'api_response_raw.txt')
-            with open(raw_response_path, 'w', encoding='utf-8') as f:
+            print(f"JSON parsing error: {str(e)}")
+            error_path = os.path.join(diagnostics_folder, 'api_response_error.txt')
+            with open(error_path, 'w', encoding='utf-8') as f:
                 f.write(response_text)
-            print(f"Raw API response saved to {raw_response_path}")
+                f.write("\n\n--- JSON PARSE ERROR ---\n")
+                f.write(str(e))
+            print(f"Error details saved to {error_path}")
+
+    api_response = {
+        "response": response_text,
+        "parsed_json": json_response if parsed_successfully else None,
+        "json_parsed_successfully": parsed_successfully,
+        "token_counts": {
+            "input_tokens": input_tokens,
+            "cache_creation_input_tokens": cache_creation_input_tokens,
+            "cache_read_input_tokens": cache_read_input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": total_tokens
+        },
+        "cost_estimate": {
+            "cache_write_cost_usd": cache_write_cost,
+            "cache_read_cost_usd": cache_read_cost,
+            "total_cost_usd": total_cost
+        }
+    }
+    if prompt_compression:
+        api_response["prompt_compression"] = prompt_compression
 
-        # Try to parse the response as JSON
-        try:
-            # Check if the response is wrapped in markdown code blocks
-            clean_response = response_text
-            if response_text.startswith("```json"):
-                end_marker = "```"
-                end_pos = response_text.rfind(end_marker)
-                if end_pos > 0:
-                    clean_response = response_text[7:end_pos].strip()
-                    
-                    if debug_mode:
-                        cleaned_path = os.path.join(diagnostics_folder, 'api_response_cleaned.txt')
-                        with open(cleaned_path, 'w', encoding='utf-8') as f:
-                            f.write(clean_response)
-                        print(f"Cleaned API response saved to {cleaned_path}")
-            
-            json_response = json.loads(clean_response)
-            parsed_successfully = True
-            
-            if debug_mode:
-                parsed_path = os.path.join(diagnostics_folder, 'api_response_parsed.json')
-                with open(parsed_path, 'w', encoding='utf-8') as f:
-                    json.dump(json_response, f, indent=2)
-                print(f"Parsed JSON saved to {parsed_path}")
-                
-        except json.JSONDecodeError as e:
-            parsed_successfully = False
-            json_response = None
-            
-            if debug_mode:
-                print(f"JSON parsing error: {str(e)}")
-                error_path = os.path.join(diagnostics_folder, 'api_response_error.txt')
-                with open(error_path, 'w', encoding='utf-8') as f:
-                    f.write(response_text)
-                    f.write("\n\n--- JSON PARSE ERROR ---\n")
-                    f.write(str(e))
-                print(f"Error details saved to {error_path}")
+    return api_response
+
+# API call to extract speaker attributions
+def API_call(text, spacy_patterns, operator_attributions, config_data, debug_mode=False, use_cache=True):
+    # Return the cached response if the same inputs were already sent to the API
+    cached_response, cache_key = lookup_cached_api_response(text, spacy_patterns, operator_attributions, config_data, use_cache)
+    if cached_response is not None:
+        return cached_response
+
+    import anthropic
+    request_params, prompt_compression = build_api_request(text, spacy_patterns, operator_attributions, config_data)
+    client = anthropic.Anthropic(**get_client_kwargs(config_data))
+
+    if debug_mode:
+        print(f"Running API call using {request_params['model']}...")
+
+    try:
+        message = client.messages.create(**request_params)
+        api_response = parse_api_message(message, config_data, debug_mode, prompt_compression)
+        store_cached_api_response(cache_key, api_response, config_data)
+        return api_response
 
+    except Exception as e:
+        if debug_mode:
+            print(f"API call exception: {str(e)}")
         return {
-            "response": response_text,
-            "parsed_json": json_response if parsed_successfully else None,
-            "json_parsed_successfully": parsed_successfully,
-            "token_counts": {
-                "input_tokens": input_tokens,
-                "output_tokens": output_tokens,
-                "total_tokens": total_tokens
-            },
-            "cost_estimate": {
-                "total_cost_usd": total_cost
-            }
+            "error": str(e)
         }
 
+
+# Token bucket limiter for requests or tokens per minute
+class TokenBucket:
+    """Token bucket that refills continuously at rate_per_minute up to a capacity of rate_per_minute."""
+
+    def __init__(self, rate_per_minute):
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.rate_per_second = rate_per_minute / 60.0
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        """Wait until the amount is available and take it from the bucket."""
+        # Requests larger than the bucket would wait forever; they take the whole bucket instead
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+                self.updated_at = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate_per_second)
+
+# HTTP status codes that are retried with exponential backoff (rate limited, overloaded)
+RETRY_STATUS_CODES = (429, 529)
+
+def create_api_dispatcher(config_data):
+    """
+    Create the shared state for concurrent API calls: one AsyncAnthropic client,
+    a concurrency semaphore and request/token rate limiters.
+    """
+    import anthropic
+    dispatch_setup = get_dispatch_setup(config_data)
+    client_kwargs = get_client_kwargs(config_data)
+    # Retries are handled by the dispatcher so that they respect the rate limiters
+    client_kwargs["max_retries"] = 0
+
+    return {
+        "client": anthropic.AsyncAnthropic(**client_kwargs),
+        "semaphore": asyncio.Semaphore(dispatch_setup["max_concurrency"]),
+        "request_limiter": TokenBucket(dispatch_setup["requests_per_minute"]) if dispatch_setup["requests_per_minute"] else None,
+        "token_limiter": TokenBucket(dispatch_setup["input_tokens_per_minute"]) if dispatch_setup["input_tokens_per_minute"] else None,
+        "max_retries": dispatch_setup["max_retries"],
+        "initial_backoff_seconds": dispatch_setup["initial_backoff_seconds"]
+    }
+
+# Asynchronous API call through the shared dispatcher
+async def API_call_async(dispatcher, text, spacy_patterns, operator_attributions, config_data, debug_mode=False, use_cache=True):
+    """Same as API_call, but shares one client and respects the dispatcher's limits."""
+    cached_response, cache_key = lookup_cached_api_response(text, spacy_patterns, operator_attributions, config_data, use_cache)
+    if cached_response is not None:
+        return cached_response
+
+    import anthropic
+    request_params, prompt_compression = build_api_request(text, spacy_patterns, operator_attributions, config_data)
+    prompt_text = "".join(block["text"] for block in request_params["system"]) + request_params["messages"][0]["content"]
+    input_tokens_estimate = estimate_tokens(prompt_text)
+
+    try:
+        for attempt in range(dispatcher["max_retries"] + 1):
+            if dispatcher["request_limiter"]:
+                await dispatcher["request_limiter"].acquire(1)
+            if dispatcher["token_limiter"]:
+                await dispatcher["token_limiter"].acquire(input_tokens_estimate)
+
+            async with dispatcher["semaphore"]:
+                try:
+                    message = await dispatcher["client"].messages.create(**request_params)
+                    break
+                except anthropic.APIStatusError as e:
+                    if e.status_code not in RETRY_STATUS_CODES or attempt == dispatcher["max_retries"]:
+                        raise
+                    status_code = e.status_code
+                    # Use the server's retry-after if given, otherwise exponential backoff with jitter
+                    retry_after = e.response.headers.get("retry-after")
+                    try:
+                        delay = float(retry_after)
+                    except (TypeError, ValueError):
+                        delay = dispatcher["initial_backoff_seconds"] * 2 ** attempt
+                        delay += random.uniform(0, delay / 2)
+
+            if debug_mode:
+                print(f"API returned {status_code}, retrying in {delay:.1f}s (attempt {attempt + 1})")
+            await asyncio.sleep(delay)
+
+        api_response = parse_api_message(message, config_data, debug_mode, prompt_compression)
+        store_cached_api_response(cache_key, api_response, config_data)
+        return api_response
+
     except Exception as e:
         if debug_mode:
             print(f"API call exception: {str(e)}")
@@ -931,6 +1983,143 @@ def remove_leading_duplicate_tags(attribution):
 
     return attribution
 
+# Build Aho-Corasick automaton to find all attributions in a single pass over the text
+def build_attribution_automaton(attributions):
+    """
+    Build an Aho-Corasick automaton from speaker attributions.
+
+    Args:
+        attributions (list): List of dictionaries with "speaker_name" and "attribution"
+
+    Returns:
+        dict: Automaton with goto/fail transitions and, for each state, the index of
+              the longest attribution ending in that state (None if no attribution ends there)
+    """
+    goto = [{}]
+    fail = [0]
+    output = [None]
+
+    # Build the trie of all attributions
+    for index, attr_info in enumerate(attributions):
+        state = 0
+        for char in attr_info["attribution"]:
+            next_state = goto[state].get(char)
+            if next_state is None:
+                next_state = len(goto)
+                goto.append({})
+                fail.append(0)
+                output.append(None)
+                goto[state][char] = next_state
+            state = next_state
+        # Identical attributions: the first speaker wins
+        if state and output[state] is None:
+            output[state] = index
+
+    # Breadth-first pass to set failure links; a state's own attribution is always longer
+    # than the attributions reachable via its failure link, so it keeps priority
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for char, next_state in goto[state].items():
+            queue.append(next_state)
+            fail_state = fail[state]
+            while fail_state and char not in goto[fail_state]:
+                fail_state = fail[fail_state]
+            fail[next_state] = goto[fail_state].get(char, 0) if state else 0
+            if output[next_state] is None:
+                output[next_state] = output[fail[next_state]]
+
+    # Characters that can start an attribution, used to skip ahead while in the root state
+    start_chars = re.compile('[' + ''.join(re.escape(char) for char in goto[0]) + ']') if goto[0] else None
+
+    return {
+        "attributions": attributions,
+        "goto": goto,
+        "fail": fail,
+        "output": output,
+        "start_chars": start_chars
+    }
+
+# Find attributions in the text with the Aho-Corasick automaton
+def find_attribution_matches(text, automaton):
+    """
+    Scan the text once and report attribution matches.
+
+    Where attributions are nested and end at the same position (e.g. "Barnum:" inside
+    "Jeremy Barnum:"), only the longest one is reported.
+
+    Returns:
+        list: List of dictionaries with "speaker_name", "start" and "end", ordered by end position
+    """
+    attributions = automaton["attributions"]
+    goto = automaton["goto"]
+    fail = automaton["fail"]
+    output = automaton["output"]
+    start_chars = automaton["start_chars"]
+
+    matches = []
+    if start_chars is None:
+        return matches
+
+    state = 0
+    pos = 0
+    text_length = len(text)
+    while pos < text_length:
+        # In the root state jump straight to the next character that can start an attribution
+        if state == 0:
+            next_start = start_chars.search(text, pos)
+            if next_start is None:
+                break
+            pos = next_start.start()
+
+        char = text[pos]
+        while state and char not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(char, 0)
+
+        index = output[state]
+        if index is not None:
+            attr_info = attributions[index]
+            matches.append({
+                "speaker_name": attr_info["speaker_name"],
+                "start": pos + 1 - len(attr_info["attribution"]),
+                "end": pos + 1
+            })
+        pos += 1
+
+    return matches
+
+# Resolve overlapping attribution matches with a sorted sweep
+def resolve_overlapping_matches(matches):
+    """
+    Collapse overlapping or contained matches to the longest one.
+
+    A short attribution like "Jeremy Barnum" matching inside the longer
+    "Jeremy Barnum <TAG_2> Chief Financial Officer..." would otherwise produce
+    an empty or truncated utterance between the two matches.
+
+    Args:
+        matches (list): List of dictionaries with "speaker_name", "start" and "end"
+
+    Returns:
+        list: Non-overlapping matches sorted by start position
+    """
+    # Sort by start, longest first for matches starting at the same position
+    sorted_matches = sorted(matches, key=lambda x: (x["start"], x["start"] - x["end"]))
+
+    resolved = []
+    for match in sorted_matches:
+        if resolved and match["start"] < resolved[-1]["end"]:
+            # Overlaps the last kept match: keep the longer one (the earlier one on ties).
+            # Kept matches never overlap, so the replacement cannot overlap earlier ones.
+            last_match = resolved[-1]
+            if match["end"] - match["start"] > last_match["end"] - last_match["start"]:
+                resolved[-1] = match
+        else:
+            resolved.append(match)
+
+    return resolved
+
 def get_utterances(text, api_response, config_data, debug_mode=False):
     """
     Extract utterances from transcript text using speaker attributions from API response.
@@ -1002,25 +2191,15 @@ def get_utterances(text, api_response, config_data, debug_mode=False):
         "attribution": remove_leading_duplicate_tags(attr["attribution"])
     } for attr in all_attributions]
     
-    # Find all matches for all attributions directly in the text
-    all_matches = []
-    for attr_info in all_attributions:
-        attribution = attr_info["attribution"]
-        # Find all occurrences of this attribution in the text
-        start_pos = 0
-        while True:
-            pos = text.find(attribution, start_pos)
-            if pos == -1:
-                break
-            all_matches.append({
-                "speaker_name": attr_info["speaker_name"],
-                "start": pos,
-                "end": pos + len(attribution)
-            })
-            start_pos = pos + 1  # Move past the current match to find the next one
+    # Find all matches for all attributions in a single pass over the text
+    automaton = build_attribution_automaton(all_attributions)
+    all_matches = find_attribution_matches(text, automaton)
     
-    # Sort matches by their position in the text
-    all_matches.sort(key=lambda x: x["start"])
+    # Collapse overlapping matches to the longest attribution, sorted by position in the text
+    match_count = len(all_matches)
+    all_matches = resolve_overlapping_matches(all_matches)
+    if debug_mode:
+        print(f"Resolved {match_count} attribution matches to {len(all_matches)} non-overlapping matches")
     
     if not all_matches:
         return []
@@ -1052,7 +2231,7 @@ def get_utterances(text, api_response, config_data, debug_mode=False):
     
     return utterances
 
-def clean_utterances(utterances: list, api_response: dict) -> list:
+def clean_utterances(utterances: list, api_response: dict, apply_header_footer_patterns: bool = True) -> list:
     cleaned_utterances = []
 
     # Remove empty utterances
@@ -1072,25 +2251,10 @@ def clean_utterances(utterances: list, api_response: dict) -> list:
     for utterance in utterances:
         text = utterance['utterance']
 
-        # Remove text within <>
-        angle_brackets_count = len(re.findall(r'<[^>]*>', text))
-        text = re.sub(r'<[^>]*>', '', text)
-        debug_counts['angle_brackets'] += angle_brackets_count
-
-        # Remove text within ()
-        parentheses_count = len(re.findall(r'\([^)]*\)', text))
-        text = re.sub(r'\([^)]*\)', '', text)
-        debug_counts['parentheses'] += parentheses_count
-
-        # Remove text within //
-        double_slashes_count = len(re.findall(r'//[^/]*//', text))
-        text = re.sub(r'//[^/]*//', '', text)
-        debug_counts['double_slashes'] += double_slashes_count
-
-        # Remove text within \\
-        backslashes_count = len(re.findall(r'\\[^\\]*\\', text))
-        text = re.sub(r'\\[^\\]*\\', '', text)
-        debug_counts['backslashes'] += backslashes_count
+        # Remove text within <>, (), // and \\ (counting removals in the same pass)
+        for cleaning_type in ('angle_brackets', 'parentheses', 'double_slashes', 'backslashes'):
+            text, count = TEXT_PATTERNS[cleaning_type].subn('', text)
+            debug_counts[cleaning_type] += count
 
         # Remove extra white spaces
         text = ' '.join(text.split())
@@ -1110,8 +2274,9 @@ def clean_utterances(utterances: list, api_response: dict) -> list:
         cleaned_utterances.append(cleaned_utterance)
 
     # Remove header pattern from each utterance's text (not removing the whole utterance)
+    # (not needed when repeating headers and footers are stripped at extraction)
     header_pattern = api_response.get("header_pattern", None) if isinstance(api_response, dict) else None
-    if header_pattern:  # Only process if header_pattern exists
+    if header_pattern and apply_header_footer_patterns:  # Only process if header_pattern exists
         cleaned_header_pattern = re.sub(r'<(?:TAG_2|TAG_3|TAG_4|BOLD-|-BOLD)>', '', header_pattern)
         for utterance in utterances:
             # Replace the matching pattern with an empty string, keeping the rest of the text
@@ -1123,7 +2288,7 @@ def clean_utterances(utterances: list, api_response: dict) -> list:
 
     # Remove footer from all utterances
     footer_pattern = api_response.get("footer_pattern", None) if isinstance(api_response, dict) else None
-    if footer_pattern:  # Only process if footer_pattern exists
+    if footer_pattern and apply_header_footer_patterns:  # Only process if footer_pattern exists
         cleaned_footer_pattern = re.sub(r'<(?:TAG_2|TAG_3|TAG_4|BOLD-|-BOLD)>', '', footer_pattern)
         for utterance in utterances:
             # Replace the matching pattern with an empty string, keeping the rest of the text
@@ -1174,7 +2339,907 @@ def create_and_save_final_json(api_response, cleaned_utterances, output_path, de
     return final_json
 
 
-### 6. MAIN FUNCTION ###
+### 6. KNOWN ATTRIBUTION REGISTRY ###
+
+# Words of a registry attribution may be separated by any whitespace and formatting tags
+REGISTRY_WORD_SEPARATOR = r'(?:\s|<[^>]+>)+'
+
+# Bank code from file names like "qec_jpm_2023_1Q.pdf" or "qec_jpm_2023_1Q_final.json"
+def get_bank_code(file_name):
+    match = re.match(r'qec_([a-z]+)_', os.path.basename(file_name or ""))
+    return match.group(1) if match else None
+
+# Strip formatting tags and extra whitespace (from "<TAG_2> JAMES VON MOLTKE <TAG_2>" to "James Von Moltke")
+def normalize_attribution(attribution):
+    text = ' '.join(re.sub(r'<[^>]+>', ' ', attribution).split())
+    return normalize_adjacent_uppercase_words(text)
+
+# Template of the reporting period format used by a bank (from "1Q23" or "Q1 2023")
+def get_reporting_period_format(reporting_period):
+    if re.fullmatch(r'\dQ\d{2}', reporting_period or ''):
+        return "{quarter}Q{yy}"
+    return "Q{quarter} {year}"
+
+def add_unique(values, new_values):
+    """Append values that are not in the list yet, preserving order."""
+    for value in new_values:
+        if value and value not in values:
+            values.append(value)
+
+def build_attribution_registry(final_json_folder, registry_path):
+    """
+    Build a per-bank registry of known participants from existing final JSON files.
+
+    Participants of the same bank are merged across quarters when they share a name variant.
+    Attributions are stored without formatting tags so that they can be matched against
+    text produced by any version of the text pipeline.
+
+    Returns:
+        dict: The registry that was saved to registry_path
+    """
+    banks = {}
+    for file_name in sorted(os.listdir(final_json_folder)):
+        bank_code = get_bank_code(file_name)
+        if not file_name.endswith('_final.json') or not bank_code:
+            continue
+        with open(os.path.join(final_json_folder, file_name), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        bank = banks.setdefault(bank_code, {"bank_name": None, "reporting_period_format": None, "participants": []})
+        bank["bank_name"] = bank["bank_name"] or data.get("bank_name")
+        bank["reporting_period_format"] = bank["reporting_period_format"] or get_reporting_period_format(data.get("reporting_period"))
+
+        for participant in data.get("participants", []):
+            name_variants = [normalize_attribution(name) for name in participant.get("speaker_name_variants", [])]
+            if not name_variants:
+                continue
+
+            # Merge with a known participant sharing any name variant
+            lower_names = {name.lower() for name in name_variants}
+            entry = next((e for e in bank["participants"] if lower_names & {name.lower() for name in e["speaker_name_variants"]}), None)
+            if entry is None:
+                entry = {
+                    "speaker_name_variants": [],
+                    "speaker_title_variants": [],
+                    "speaker_company_variants": [],
+                    "attribution_cores": []
+                }
+                bank["participants"].append(entry)
+
+            add_unique(entry["speaker_name_variants"], name_variants)
+            add_unique(entry["speaker_title_variants"], participant.get("speaker_title_variants", []))
+            add_unique(entry["speaker_company_variants"], participant.get("speaker_company_variants", []))
+            add_unique(entry["attribution_cores"], [normalize_attribution(a) for a in participant.get("speaker_attributions", [])])
+
+    registry = {"banks": banks}
+    with open(registry_path, 'w', encoding='utf-8') as f:
+        json.dump(registry, f, indent=2, ensure_ascii=False)
+    print(f"Attribution registry with {len(banks)} banks saved to {registry_path}")
+    return registry
+
+def load_attribution_registry(registry_path):
+    try:
+        with open(registry_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+# Name variants of the registry participants of the transcript's bank (empty if unknown)
+def get_roster_names(file_name, config_data):
+    registry_setup = get_registry_setup(config_data)
+    if not registry_setup["enabled"]:
+        return []
+    bank = load_attribution_registry(registry_setup["registry_path"]).get("banks", {}).get(get_bank_code(file_name))
+    if not bank:
+        return []
+    names = []
+    for entry in bank["participants"]:
+        add_unique(names, entry["speaker_name_variants"])
+    return names
+
+# Regex for a registry attribution that must start a line (or follow a tag or a sentence end)
+def compile_attribution_core(core):
+    pattern = REGISTRY_WORD_SEPARATOR.join(re.escape(word) for word in core.split())
+    # Attributions without trailing punctuation must be followed by a tag
+    if core[-1].isalnum():
+        pattern += r'(?=\s*(?:<[^>]+>|$))'
+    return re.compile(r'(?:^|(?<=\n)|(?<=>\s)|(?<=[.?!]\s))' + pattern)
+
+# Call date (from the first page) and reporting period (from the file name)
+def extract_call_details(full_text, file_name, bank):
+    first_page = full_text.split('<PAGE_BREAK>')[0]
+    months = r'(January|February|March|April|May|June|July|August|September|October|November|December)'
+    call_date = None
+    date_match = re.search(months + r'\s+(\d{1,2}),\s+(\d{4})', first_page)
+    if date_match:
+        call_date = datetime.strptime(' '.join(date_match.groups()), '%B %d %Y').strftime('%Y-%m-%d')
+    else:
+        date_match = re.search(r'(\d{1,2})(?:st|nd|rd|th)?\s+' + months + r'\s+(\d{4})', first_page)
+        if date_match:
+            call_date = datetime.strptime(' '.join(date_match.groups()), '%d %B %Y').strftime('%Y-%m-%d')
+
+    reporting_period = None
+    period_match = re.search(r'_(\d{4})_(\d)Q', os.path.basename(file_name))
+    if period_match:
+        year, quarter = period_match.groups()
+        reporting_period = bank["reporting_period_format"].format(quarter=quarter, year=year, yy=year[2:])
+
+    return {
+        "bank_name": bank["bank_name"],
+        "call_date": call_date,
+        "reporting_period": reporting_period
+    }
+
+def match_known_attributions(file_name, full_text, potential_attributions, config_data):
+    """
+    Find the registry participants of the transcript's bank in the text.
+
+    Coverage is the share of line-start spaCy suggestions (those starting with a
+    formatting tag) that contain a name of a participant found in the text.
+
+    Returns:
+        dict: parsed_json built from the registry, uncovered suggestions and coverage,
+              or None if the registry is disabled or has no entry for the bank
+    """
+    registry_setup = get_registry_setup(config_data)
+    if not registry_setup["enabled"]:
+        return None
+    bank = load_attribution_registry(registry_setup["registry_path"]).get("banks", {}).get(get_bank_code(file_name))
+    if not bank:
+        return None
+
+    participants = []
+    for entry in bank["participants"]:
+        attributions = []
+        for core in entry["attribution_cores"]:
+            add_unique(attributions, [match.group(0) for match in compile_attribution_core(core).finditer(full_text)])
+        if attributions:
+            participants.append({
+                "speaker_name_variants": entry["speaker_name_variants"],
+                "speaker_title_variants": entry["speaker_title_variants"],
+                "speaker_company_variants": entry["speaker_company_variants"],
+                "speaker_attributions": attributions
+            })
+
+    # Line-start suggestions that do not contain the name of a found participant
+    known_names = [name for participant in participants for name in participant["speaker_name_variants"]]
+    line_start_patterns = [pattern for pattern in potential_attributions if pattern.lstrip().startswith('<')]
+    missing_patterns = [
+        pattern for pattern in line_start_patterns
+        if not any(name in normalize_attribution(pattern) for name in known_names)
+    ]
+    coverage = 1 - len(missing_patterns) / len(line_start_patterns) if line_start_patterns else 1.0
+
+    parsed_json = extract_call_details(full_text, file_name, bank)
+    parsed_json.update({
+        "header_pattern": None,
+        "footer_pattern": None,
+        "participants": participants
+    })
+    return {
+        "parsed_json": parsed_json,
+        "missing_patterns": missing_patterns,
+        "coverage": coverage
+    }
+
+def apply_attribution_registry(file_name, full_text, spacy_patterns, config_data):
+    """
+    Try to resolve the speakers of a transcript from the registry.
+
+    Returns:
+        tuple: (registry match or None,
+                API response built from the registry if coverage is sufficient, else None,
+                spaCy patterns to send to the API: only the missing speakers if the registry matched)
+    """
+    registry_match = match_known_attributions(file_name, full_text, spacy_patterns[0], config_data)
+    if registry_match is None:
+        return None, None, spacy_patterns
+
+    print(f"Registry covers {registry_match['coverage']:.0%} of line-start speaker suggestions.")
+    if registry_match["coverage"] >= get_registry_setup(config_data)["min_coverage"]:
+        # With min_coverage below 1, unknown speakers are merged into the previous utterance: report them
+        parsed_json = registry_match["parsed_json"]
+        if registry_match["missing_patterns"]:
+            print(f"Warning: {len(registry_match['missing_patterns'])} speaker suggestions not in the registry: {registry_match['missing_patterns']}")
+            parsed_json = {**parsed_json, "unmatched_patterns": registry_match["missing_patterns"]}
+        api_response = {
+            "response": json.dumps(parsed_json),
+            "parsed_json": parsed_json,
+            "json_parsed_successfully": True,
+            "registry_hit": True,
+            "token_counts": {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0},
+            "cost_estimate": {"total_cost_usd": 0.0}
+        }
+        return registry_match, api_response, spacy_patterns
+
+    # Ask the API only about the speakers the registry does not know
+    known_names = [participant["speaker_name_variants"][0] for participant in registry_match["parsed_json"]["participants"]]
+    missing_patterns = registry_match["missing_patterns"]
+    formatted_patterns = f"Speakers already known (do not repeat them): {', '.join(known_names)}\n\n"
+    formatted_patterns += format_pattern_with_context(missing_patterns, full_text)
+    return registry_match, None, (missing_patterns, formatted_patterns)
+
+def merge_registry_response(registry_match, api_response):
+    """Add the registry participants to an API response asked only about missing speakers."""
+    if registry_match is None or api_response.get("parsed_json") is None:
+        return api_response
+
+    merged_response = copy.deepcopy(api_response)
+    participants = merged_response["parsed_json"].setdefault("participants", [])
+    for known in registry_match["parsed_json"]["participants"]:
+        lower_names = {name.lower() for name in known["speaker_name_variants"]}
+        participant = next((p for p in participants if lower_names & {name.lower() for name in p.get("speaker_name_variants", [])}), None)
+        if participant is None:
+            participants.append(copy.deepcopy(known))
+        else:
+            add_unique(participant.setdefault("speaker_attributions", []), known["speaker_attributions"])
+    return merged_response
+
+
+### 7. CHECKPOINTS ###
+
+# Bump when the checkpoint file layout changes so that old checkpoints are ignored
+CHECKPOINT_VERSION = 1
+
+# Pipeline stages in execution order ("clean" has no checkpoint, it writes the final JSON)
+PIPELINE_STAGES = ["extract", "spacy", "api", "utterances", "clean"]
+
+# Hash of JSON-serializable stage inputs
+def get_fingerprint(*parts):
+    """Return a SHA-256 fingerprint of the given stage inputs."""
+    parts_json = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(parts_json.encode('utf-8')).hexdigest()
+
+# Hash of the PDF file contents
+def get_file_fingerprint(file_path):
+    """Return a SHA-256 fingerprint of a file's bytes."""
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def get_checkpoint_dir(config_data, file_path):
+    """Return the checkpoint folder for a PDF, or None if checkpoints are disabled."""
+    checkpoint_setup = get_checkpoint_setup(config_data)
+    if not checkpoint_setup["enabled"]:
+        return None
+    file_stem = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(checkpoint_setup["checkpoint_folder"], file_stem)
+
+# Whether a stage should be loaded from its checkpoint instead of recomputed
+def resume_stage(stage, from_stage):
+    if from_stage is None:
+        return False
+    return PIPELINE_STAGES.index(stage) < PIPELINE_STAGES.index(from_stage)
+
+def save_checkpoint(checkpoint_dir, stage, input_fingerprint, data):
+    """Persist the output of a stage together with the fingerprint of its inputs."""
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    checkpoint = {
+        "version": CHECKPOINT_VERSION,
+        "stage": stage,
+        "input_fingerprint": input_fingerprint,
+        "data": data
+    }
+
+    # Write to a temporary file first so that a crash never leaves a partial checkpoint
+    file_path = os.path.join(checkpoint_dir, f"{stage}.json")
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(temp_path, file_path)
+
+def load_checkpoint(checkpoint_dir, stage, input_fingerprint):
+    """Return the stored output of a stage, or None if missing, outdated or built from other inputs."""
+    file_path = os.path.join(checkpoint_dir, f"{stage}.json")
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        return None
+    if checkpoint.get("input_fingerprint") != input_fingerprint:
+        return None
+
+    print(f"Loaded '{stage}' stage from checkpoint {file_path}")
+    return checkpoint.get("data")
+
+
+### 8. TRANSCRIPT PROCESSING ###
+
+SPACY_MODEL = "en_core_web_sm"  # optional: "en_core_web_trf" transformer model for better accuracy
+
+# Pipeline components loaded for each profile
+# extract_speaker_attributions only uses entities (ner), POS (tagger + attribute_ruler) and sentence starts
+SPACY_PIPE_PROFILES = {
+    "full": [],  # excluded components
+    "fast": ["lemmatizer", "parser"]  # sentence starts from senter, or sentencizer if the model has no senter
+}
+
+# spaCy models loaded in this process
+_nlp_models = {}
+
+def load_nlp(model_name=None, pipe_profile="full"):
+    """Load a spaCy model with the components of a pipe profile once per process."""
+    import spacy
+    model_name = model_name or SPACY_MODEL
+    if (model_name, pipe_profile) not in _nlp_models:
+        nlp = spacy.load(model_name, exclude=SPACY_PIPE_PROFILES[pipe_profile])
+
+        # Sentence starts without the parser
+        if "parser" not in nlp.pipe_names and "senter" not in nlp.pipe_names:
+            if "senter" in nlp.component_names:
+                nlp.enable_pipe("senter")
+            elif "sentencizer" not in nlp.pipe_names:
+                nlp.add_pipe("sentencizer", before="ner" if "ner" in nlp.pipe_names else None)
+
+        _nlp_models[(model_name, pipe_profile)] = nlp
+    return _nlp_models[(model_name, pipe_profile)]
+
+# Blank pipeline of the model language: tokenizer only, no statistical components
+def load_tokenizer_nlp(lang="en"):
+    import spacy
+    if ("blank", lang) not in _nlp_models:
+        _nlp_models[("blank", lang)] = spacy.blank(lang)
+    return _nlp_models[("blank", lang)]
+
+# Collect spaCy and operator attribution suggestions
+def get_spacy_data(full_text, nlp, config_data=None, debug_mode=False, roster_names=None):
+    if roster_names:
+        potential_attributions, formatted_patterns = extract_roster_attributions(full_text, nlp, roster_names, config_data, debug_mode)
+    else:
+        potential_attributions, formatted_patterns = extract_speaker_attributions(full_text, nlp, config_data, debug_mode)
+    return {
+        "potential_attributions": potential_attributions,
+        "formatted_patterns": formatted_patterns,
+        "operator_attributions": get_operator_attributions(full_text)
+    }
+
+# Compare spaCy suggestions of the configured pipe profile with the full pipeline
+def validate_pipe_profile(file_path, config_data):
+    """
+    Run the spaCy stage on one PDF with the full pipeline and the configured pipe profile
+    and print the time of each run and the suggestions that differ.
+
+    Returns:
+        bool: True if both runs give the same suggestions
+    """
+    pipe_profile = get_spacy_setup(config_data)["pipe_profile"]
+    full_text = text_processing_pipeline(file_path, config_data)
+
+    results = {}
+    for profile in ("full", pipe_profile):
+        nlp = load_nlp(pipe_profile=profile)
+        get_spacy_data("<TAG_2> Operator: <TAG_2>", nlp)  # warm up (special cases, matcher)
+        start_time = time.perf_counter()
+        results[profile] = get_spacy_data(full_text, nlp)["potential_attributions"]
+        print(f"{profile} pipes ({', '.join(nlp.pipe_names)}): {time.perf_counter() - start_time:.2f}s, {len(results[profile])} suggestions")
+
+    missing = [pattern for pattern in results["full"] if pattern not in results[pipe_profile]]
+    extra = [pattern for pattern in results[pipe_profile] if pattern not in results["full"]]
+    for pattern in missing:
+        print(f"- {pattern!r}")
+    for pattern in extra:
+        print(f"+ {pattern!r}")
+    print(f"{len(missing)} suggestions missing and {len(extra)} added by the {pipe_profile} profile")
+    return not missing and not extra
+
+# Run the local (non-API) stages for a single PDF
+def run_local_stages(file_path, config_data, nlp=None, debug_mode=False, checkpoint_dir=None, from_stage=None):
+    """
+    Extract text from the PDF and collect spaCy and operator attribution suggestions.
+
+    Stages before from_stage are loaded from checkpoint_dir when their checkpoint is
+    valid for the current inputs; all other stages are recomputed and checkpointed.
+
+    Returns:
+        tuple: (full_text, spacy_patterns, operator_attributions)
+    """
+    # Extract text from PDF
+    full_text = None
+    if checkpoint_dir:
+        extraction_setup = get_extraction_setup(config_data)
+        extract_fingerprint = get_fingerprint(
+            get_file_fingerprint(file_path), extraction_setup["layout_mode"], extraction_setup["strip_header_footer"],
+            extraction_setup["header_footer_band"], extraction_setup["min_page_fraction"]
+        )
+        if resume_stage("extract", from_stage):
+            full_text = load_checkpoint(checkpoint_dir, "extract", extract_fingerprint)
+    if full_text is None:
+        full_text = text_processing_pipeline(file_path, config_data, debug_mode)
+        if checkpoint_dir:
+            save_checkpoint(checkpoint_dir, "extract", extract_fingerprint, full_text)
+
+    # Extract potential speaker attributions (with the tokenizer only if the bank's roster is known)
+    pipe_profile = get_spacy_setup(config_data)["pipe_profile"]
+    roster_names = get_roster_names(file_path, config_data) if get_registry_setup(config_data)["roster_fast_path"] else []
+    spacy_data = None
+    if checkpoint_dir:
+        spacy_setup = get_spacy_setup(config_data)
+        spacy_fingerprint = get_fingerprint(
+            SPACY_MODEL, pipe_profile, spacy_setup["chunk_chars"], spacy_setup["context_chars"], spacy_setup["all_occurrences"], roster_names, full_text
+        )
+        if resume_stage("spacy", from_stage):
+            spacy_data = load_checkpoint(checkpoint_dir, "spacy", spacy_fingerprint)
+    if spacy_data is None:
+        if roster_names:
+            print(f"Matching {len(roster_names)} known speaker names with the tokenizer only.")
+            spacy_data = get_spacy_data(full_text, load_tokenizer_nlp(), config_data, debug_mode, roster_names)
+        # A running spaCy worker already has the model loaded
+        elif nlp is None:
+            spacy_data = request_spacy_worker(full_text, config_data)
+        if spacy_data is None:
+            spacy_data = get_spacy_data(full_text, nlp or load_nlp(pipe_profile=pipe_profile), config_data, debug_mode)
+        if checkpoint_dir:
+            save_checkpoint(checkpoint_dir, "spacy", spacy_fingerprint, spacy_data)
+
+    spacy_patterns = (spacy_data["potential_attributions"], spacy_data["formatted_patterns"])
+    operator_attributions = spacy_data["operator_attributions"]
+    return full_text, spacy_patterns, operator_attributions
+
+# Fingerprint of the API stage inputs
+def get_api_stage_fingerprint(full_text, spacy_patterns, operator_attributions, config_data, file_name=None):
+    model = get_api_setup(config_data)[1]
+    api_cache_key = get_api_cache_key(full_text, spacy_patterns, operator_attributions, model, get_prompt_setup(config_data))
+
+    # Responses built with the registry depend on the registry contents
+    registry_setup = get_registry_setup(config_data)
+    if not registry_setup["enabled"]:
+        return api_cache_key
+    registry_fingerprint = get_file_fingerprint(registry_setup["registry_path"]) if os.path.exists(registry_setup["registry_path"]) else None
+    return get_fingerprint(api_cache_key, get_bank_code(file_name), registry_fingerprint, registry_setup["min_coverage"])
+
+# Run the API call and utterance stages and save the final JSON
+def run_llm_stages(full_text, spacy_patterns, operator_attributions, output_path, config_data, debug_mode=False, use_cache=True, checkpoint_dir=None, from_stage=None, file_name=None):
+    """
+    Send the transcript to the API, split it into utterances and save the final JSON.
+
+    Stages before from_stage are loaded from checkpoint_dir when their checkpoint is
+    valid for the current inputs; all other stages are recomputed and checkpointed.
+
+    Returns:
+        dict: The API response (contains "error" if the API call failed)
+    """
+    # Make API call
+    api_response = None
+    if checkpoint_dir:
+        api_fingerprint = get_api_stage_fingerprint(full_text, spacy_patterns, operator_attributions, config_data, file_name)
+        if resume_stage("api", from_stage):
+            api_response = load_checkpoint(checkpoint_dir, "api", api_fingerprint)
+    if api_response is None:
+        # Known speakers come from the registry, the API is only asked about the missing ones
+        registry_match, api_response, call_spacy_patterns = apply_attribution_registry(file_name, full_text, spacy_patterns, config_data)
+    if api_response is None:
+        api_response = API_call(full_text, call_spacy_patterns, operator_attributions, config_data, debug_mode, use_cache)
+        api_response = merge_registry_response(registry_match, api_response)
+
+        # Check for errors in the API call result
+        if "error" in api_response:
+            print(f"Error: {api_response['error']}")
+            return api_response
+
+        if checkpoint_dir:
+            save_checkpoint(checkpoint_dir, "api", api_fingerprint, api_response)
+
+    run_utterance_stages(full_text, api_response, output_path, config_data, debug_mode, checkpoint_dir, from_stage)
+    return api_response
+
+# Same as run_llm_stages, but the API call goes through the concurrent dispatcher
+async def run_llm_stages_async(dispatcher, full_text, spacy_patterns, operator_attributions, output_path, config_data, debug_mode=False, use_cache=True, checkpoint_dir=None, from_stage=None, file_name=None):
+    api_response = None
+    if checkpoint_dir:
+        api_fingerprint = get_api_stage_fingerprint(full_text, spacy_patterns, operator_attributions, config_data, file_name)
+        if resume_stage("api", from_stage):
+            api_response = load_checkpoint(checkpoint_dir, "api", api_fingerprint)
+    if api_response is None:
+        registry_match, api_response, call_spacy_patterns = apply_attribution_registry(file_name, full_text, spacy_patterns, config_data)
+    if api_response is None:
+        api_response = await API_call_async(dispatcher, full_text, call_spacy_patterns, operator_attributions, config_data, debug_mode, use_cache)
+        api_response = merge_registry_response(registry_match, api_response)
+
+        if "error" in api_response:
+            print(f"Error: {api_response['error']}")
+            return api_response
+
+        if checkpoint_dir:
+            save_checkpoint(checkpoint_dir, "api", api_fingerprint, api_response)
+
+    run_utterance_stages(full_text, api_response, output_path, config_data, debug_mode, checkpoint_dir, from_stage)
+    return api_response
+
+# Split the transcript into utterances, clean them and save the final JSON
+def run_utterance_stages(full_text, api_response, output_path, config_data, debug_mode=False, checkpoint_dir=None, from_stage=None):
+    # Get utterances
+    utterances = None
+    if checkpoint_dir:
+        utterances_fingerprint = get_fingerprint(full_text, api_response.get("parsed_json"))
+        if resume_stage("utterances", from_stage):
+            utterances = load_checkpoint(checkpoint_dir, "utterances", utterances_fingerprint)
+    if utterances is None:
+        utterances = get_utterances(full_text, api_response, config_data, debug_mode)
+        if checkpoint_dir:
+            save_checkpoint(checkpoint_dir, "utterances", utterances_fingerprint, utterances)
+
+    # Clean utterances
+    cleaned_utterances = clean_utterances(utterances, api_response, not get_extraction_setup(config_data)["strip_header_footer"])
+
+    # Create and save final JSON
+    return create_and_save_final_json(api_response, cleaned_utterances, output_path, debug_mode)
+
+# Print token counts and cost of an API response
+def print_token_counts(api_response):
+    if "token_counts" in api_response:
+        print(f"Input tokens: {api_response['token_counts']['input_tokens']}")
+        print(f"Cache write tokens: {api_response['token_counts'].get('cache_creation_input_tokens', 0)}")
+        print(f"Cache read tokens: {api_response['token_counts'].get('cache_read_input_tokens', 0)}")
+        print(f"Output tokens: {api_response['token_counts']['output_tokens']}")
+        print(f"Total tokens: {api_response['token_counts']['total_tokens']}")
+        print(f"Estimated cost: ${api_response['cost_estimate']['total_cost_usd']:.2f}")
+        if api_response.get("cache_hit"):
+            print("(Cached response: no API cost for this run)")
+        if "prompt_compression" in api_response:
+            print(f"Prompt compression: {api_response['prompt_compression']['reduction_ratio']:.1f}x fewer transcript tokens")
+    else:
+        print("Token counts not available in the API response.")
+
+
+### 9. SPACY WORKER ###
+
+class SpacyWorkerHandler(socketserver.StreamRequestHandler):
+    """Serve spaCy extraction requests of one connection, one JSON object per line."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if "text" in request:
+                    # Chunking and context options of the client
+                    config_data = {**self.server.config_data, "spacy_setup": request.get("spacy_setup", {})}
+                    response = get_spacy_data(request["text"], self.server.nlp, config_data)
+                else:
+                    response = {}  # ping
+                response["model"] = self.server.model_name
+                response["pipe_profile"] = self.server.pipe_profile
+            except Exception as e:
+                response = {"error": str(e)}
+            self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+            self.wfile.flush()
+
+def run_spacy_worker(config_data, model_name=None):
+    """
+    Keep a spaCy model loaded and serve extraction requests on a Unix socket.
+
+    Each request is a JSON line {"text": full_text, "spacy_setup": client spaCy setup}; the response is a JSON line with
+    potential_attributions, formatted_patterns, operator_attributions and the model name.
+    Runs until interrupted.
+    """
+    socket_path = get_spacy_worker_setup(config_data)["socket_path"]
+    model_name = model_name or SPACY_MODEL
+    pipe_profile = get_spacy_setup(config_data)["pipe_profile"]
+
+    # Load the model, tokenizer special cases and matcher once
+    nlp = load_nlp(model_name, pipe_profile)
+    get_spacy_data("<TAG_2> Operator: <TAG_2>", nlp)
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)  # left over from a worker that did not shut down
+    with socketserver.UnixStreamServer(socket_path, SpacyWorkerHandler) as server:
+        server.nlp = nlp
+        server.model_name = model_name
+        server.pipe_profile = pipe_profile
+        server.config_data = config_data
+        print(f"spaCy worker with {model_name} ({pipe_profile} pipes) listening on {socket_path} (Ctrl+C to stop)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("spaCy worker stopped.")
+        finally:
+            os.remove(socket_path)
+
+def request_spacy_worker(full_text, config_data):
+    """
+    Get spaCy suggestions from a running spaCy worker.
+
+    Returns:
+        dict: spaCy data as returned by get_spacy_data, or None if no worker with
+              SPACY_MODEL and the configured pipe profile is listening (the caller then runs spaCy locally)
+    """
+    worker_setup = get_spacy_worker_setup(config_data)
+    socket_path = worker_setup["socket_path"]
+    if not worker_setup["enabled"] or not hasattr(socket, "AF_UNIX") or not os.path.exists(socket_path):
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(worker_setup["timeout_seconds"])
+            sock.connect(socket_path)
+            with sock.makefile('rwb') as stream:
+                request = {"text": full_text, "spacy_setup": get_spacy_setup(config_data)}
+                stream.write((json.dumps(request) + "\n").encode('utf-8'))
+                stream.flush()
+                response = json.loads(stream.readline())
+    except (OSError, ValueError) as e:
+        print(f"spaCy worker not available ({str(e)}), running spaCy locally.")
+        return None
+
+    if "error" in response:
+        print(f"spaCy worker error: {response['error']}, running spaCy locally.")
+        return None
+    if (response.pop("model", None), response.pop("pipe_profile", None)) != (SPACY_MODEL, get_spacy_setup(config_data)["pipe_profile"]):
+        print("spaCy worker uses a different model or pipe profile, running spaCy locally.")
+        return None
+
+    print(f"spaCy suggestions received from the worker at {socket_path}")
+    return response
+
+
+### 10. BATCH PROCESSING ###
+
+def run_batch_worker(file_path, config_data, from_stage=None):
+    """Run the local stages for one PDF inside a worker process."""
+    # The spaCy model is loaded once per worker process by load_nlp
+    # Diagnostics files use fixed names, so they are not written from parallel workers
+    # Files are already processed in parallel, so pages are extracted sequentially
+    # and each worker runs spaCy itself (in one process) instead of queueing at a single spaCy worker
+    config_data = {
+        **config_data,
+        "extraction_setup": {**config_data.get("extraction_setup", {}), "page_workers": 1},
+        "spacy_worker_setup": {**config_data.get("spacy_worker_setup", {}), "enabled": False},
+        "spacy_setup": {**config_data.get("spacy_setup", {}), "n_process": 1}
+    }
+    checkpoint_dir = get_checkpoint_dir(config_data, file_path)
+    return run_local_stages(file_path, config_data, None, False, checkpoint_dir, from_stage)
+
+def run_batch(batch_folder, config_data, max_workers=None, debug_mode=False, use_cache=True, from_stage=None):
+    """
+    Process every PDF in a folder, running the local stages in a process pool.
+
+    Text extraction and spaCy run in worker processes (each loads the spaCy model once when needed);
+    as each file completes its API call is sent through the concurrent dispatcher, so API
+    round trips overlap with each other and with the extraction of the remaining files.
+
+    Args:
+        batch_folder (str): Folder with the PDF transcripts
+        config_data (dict): Configuration dictionary
+        max_workers (int): Number of worker processes (default: batch_setup or CPU count)
+        debug_mode (bool): Whether to print debug information
+        use_cache (bool): Whether to reuse cached API responses
+        from_stage (str): Resume each file from this stage using valid checkpoints
+
+    Returns:
+        dict: Output JSON path for each successfully processed PDF
+    """
+    final_json_folder = get_folder_paths(config_data)["final_json_folder"]
+    if not os.path.exists(final_json_folder):
+        os.makedirs(final_json_folder)
+        print(f"Created directory: {final_json_folder}")
+
+    pdf_files = sorted(f for f in os.listdir(batch_folder) if f.lower().endswith('.pdf'))
+    if not pdf_files:
+        print(f"No PDF files found in '{batch_folder}'.")
+        return {}
+
+    if max_workers is None:
+        max_workers = get_batch_setup(config_data)["max_workers"] or os.cpu_count() or 1
+    max_workers = min(max_workers, len(pdf_files))
+    print(f"Processing {len(pdf_files)} PDF files with {max_workers} worker processes...")
+
+    outputs = asyncio.run(run_batch_async(batch_folder, pdf_files, final_json_folder, config_data, max_workers, debug_mode, use_cache, from_stage))
+
+    print(f"Batch complete: {len(outputs)} of {len(pdf_files)} files processed.")
+    return outputs
+
+
+async def run_batch_async(batch_folder, pdf_files, final_json_folder, config_data, max_workers, debug_mode=False, use_cache=True, from_stage=None):
+    """Run the local stages in a process pool and the API calls concurrently on the event loop."""
+    loop = asyncio.get_running_loop()
+    dispatcher = create_api_dispatcher(config_data)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+
+        async def process_file(file_name):
+            try:
+                full_text, spacy_patterns, operator_attributions = await loop.run_in_executor(
+                    executor, run_batch_worker, os.path.join(batch_folder, file_name), config_data, from_stage
+                )
+            except Exception as e:
+                print(f"Error extracting {file_name}: {str(e)}")
+                return None
+
+            print(f"Sending {file_name} to API for analysis...")
+            output_path = os.path.join(final_json_folder, file_name.replace('.pdf', '_final.json'))
+            checkpoint_dir = get_checkpoint_dir(config_data, file_name)
+            api_response = await run_llm_stages_async(dispatcher, full_text, spacy_patterns, operator_attributions, output_path, config_data, debug_mode, use_cache, checkpoint_dir, from_stage, file_name)
+            if "error" in api_response:
+                return None
+            if debug_mode:
+                print_token_counts(api_response)
+            return output_path
+
+        output_paths = await asyncio.gather(*(process_file(file_name) for file_name in pdf_files))
+
+    await dispatcher["client"].close()
+    return {file_name: output_path for file_name, output_path in zip(pdf_files, output_paths) if output_path}
+
+
+### 11. MESSAGE BATCHES ###
+
+# Message Batches custom ids allow only letters, digits, "_" and "-" (up to 64 characters)
+def get_batch_custom_id(file_name):
+    file_stem = os.path.splitext(os.path.basename(file_name))[0]
+    return re.sub(r'[^A-Za-z0-9_-]', '_', file_stem)[:64]
+
+def submit_message_batch(batch_folder, config_data, max_workers=None):
+    """
+    Submit the prompts of all pending transcripts in a folder as one Message Batch.
+
+    A transcript is pending when its _final.json does not exist yet. The local stages
+    run in a process pool (and are checkpointed when checkpoints are enabled). The batch
+    id and the files of every request are saved to a manifest for collect_message_batch.
+
+    Returns:
+        str: The batch id, or None if nothing was submitted
+    """
+    import anthropic
+    final_json_folder = get_folder_paths(config_data)["final_json_folder"]
+    pdf_files = sorted(f for f in os.listdir(batch_folder) if f.lower().endswith('.pdf'))
+    pending_files = [
+        f for f in pdf_files
+        if not os.path.exists(os.path.join(final_json_folder, f.replace('.pdf', '_final.json')))
+    ]
+    if not pending_files:
+        print(f"No pending PDF files in '{batch_folder}'.")
+        return None
+
+    if max_workers is None:
+        max_workers = get_batch_setup(config_data)["max_workers"] or os.cpu_count() or 1
+    max_workers = min(max_workers, len(pending_files))
+    print(f"Preparing {len(pending_files)} pending PDF files with {max_workers} worker processes...")
+
+    pdf_paths = [os.path.join(batch_folder, f) for f in pending_files]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        local_results = list(executor.map(run_batch_worker, pdf_paths, [config_data] * len(pdf_paths)))
+
+    requests = []
+    manifest_requests = {}
+    registry_outputs = 0
+    for file_name, pdf_path, (full_text, spacy_patterns, operator_attributions) in zip(pending_files, pdf_paths, local_results):
+        output_path = os.path.join(final_json_folder, file_name.replace('.pdf', '_final.json'))
+
+        # Transcripts covered by the registry are finished locally, the others only ask about missing speakers
+        registry_match, registry_response, call_spacy_patterns = apply_attribution_registry(file_name, full_text, spacy_patterns, config_data)
+        if registry_response is not None:
+            run_utterance_stages(full_text, registry_response, output_path, config_data, False, get_checkpoint_dir(config_data, pdf_path))
+            registry_outputs += 1
+            continue
+
+        custom_id = get_batch_custom_id(file_name)
+        request_params, prompt_compression = build_api_request(full_text, call_spacy_patterns, operator_attributions, config_data)
+        requests.append({"custom_id": custom_id, "params": request_params})
+        manifest_requests[custom_id] = {
+            "pdf_path": pdf_path,
+            "output_path": output_path,
+            "prompt_compression": prompt_compression,
+            "spacy_patterns": call_spacy_patterns,
+            "registry_match": registry_match
+        }
+
+    if registry_outputs:
+        print(f"{registry_outputs} files resolved from the attribution registry without the API.")
+    if not requests:
+        print("No requests to submit.")
+        return None
+
+    client = anthropic.Anthropic(**get_client_kwargs(config_data))
+    message_batch = client.messages.batches.create(requests=requests)
+
+    # Persist the batch id and its requests so that results can be collected later
+    manifest_folder = get_message_batches_setup(config_data)["manifest_folder"]
+    if not os.path.exists(manifest_folder):
+        os.makedirs(manifest_folder)
+        print(f"Created directory: {manifest_folder}")
+    manifest = {
+        "batch_id": message_batch.id,
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "requests": manifest_requests
+    }
+    manifest_path = os.path.join(manifest_folder, f"{message_batch.id}.json")
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"Submitted Message Batch {message_batch.id} with {len(requests)} requests.")
+    print(f"Batch manifest saved to {manifest_path}")
+    return message_batch.id
+
+# Find the manifest of a batch id, or of the most recently submitted batch
+def load_message_batch_manifest(config_data, batch_id=None):
+    manifest_folder = get_message_batches_setup(config_data)["manifest_folder"]
+    if batch_id:
+        manifest_path = os.path.join(manifest_folder, f"{batch_id}.json")
+    else:
+        manifest_files = [f for f in os.listdir(manifest_folder) if f.endswith('.json')] if os.path.exists(manifest_folder) else []
+        if not manifest_files:
+            return None
+        manifest_path = max((os.path.join(manifest_folder, f) for f in manifest_files), key=os.path.getmtime)
+
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def collect_message_batch(config_data, batch_id=None, debug_mode=False):
+    """
+    Download the results of a finished Message Batch and run the utterance stages.
+
+    Responses to transcripts matched with the registry are merged with the registry
+    participants. Successful responses are also stored in the response cache and as API
+    checkpoints, so later single-file or batch runs reuse them.
+
+    Returns:
+        dict: Output JSON path for each successfully processed PDF (None if the batch is not finished)
+    """
+    import anthropic
+    manifest = load_message_batch_manifest(config_data, batch_id)
+    if manifest is None:
+        print(f"Error: No Message Batch manifest found{f' for {batch_id}' if batch_id else ''}.")
+        return None
+    batch_id = manifest["batch_id"]
+
+    client = anthropic.Anthropic(**get_client_kwargs(config_data))
+    message_batch = client.messages.batches.retrieve(batch_id)
+    if message_batch.processing_status != "ended":
+        print(f"Message Batch {batch_id} is still {message_batch.processing_status}: {message_batch.request_counts}")
+        return None
+
+    cost_multiplier = get_message_batches_setup(config_data)["cost_multiplier"]
+    cache_enabled = get_cache_setup(config_data)["enabled"]
+    model = get_api_setup(config_data)[1] or "claude-3-7-sonnet-20250219"
+    outputs = {}
+    for result in client.messages.batches.results(batch_id):
+        request_info = manifest["requests"].get(result.custom_id)
+        if request_info is None:
+            continue
+        if result.result.type != "succeeded":
+            print(f"Error: request {result.custom_id} {result.result.type}")
+            continue
+
+        api_response = parse_api_message(result.result.message, config_data, debug_mode, request_info["prompt_compression"])
+        if "error" in api_response:
+            print(f"Error: {api_response['error']}")
+            continue
+
+        # Message Batches are billed at a discount
+        for cost_name in api_response["cost_estimate"]:
+            api_response["cost_estimate"][cost_name] *= cost_multiplier
+
+        # Reload the local stages from checkpoints (or recompute them) for the utterance stages
+        pdf_path = request_info["pdf_path"]
+        checkpoint_dir = get_checkpoint_dir(config_data, pdf_path)
+        full_text, spacy_patterns, operator_attributions = run_local_stages(pdf_path, config_data, None, False, checkpoint_dir, "api")
+        if cache_enabled:
+            # Same key as API_call, so that later runs find the response in the cache
+            call_spacy_patterns = request_info.get("spacy_patterns", spacy_patterns)
+            cache_key = get_api_cache_key(full_text, call_spacy_patterns, operator_attributions, model, get_prompt_setup(config_data))
+            store_cached_api_response(cache_key, api_response, config_data)
+        api_response = merge_registry_response(request_info.get("registry_match"), api_response)
+        api_fingerprint = get_api_stage_fingerprint(full_text, spacy_patterns, operator_attributions, config_data, os.path.basename(pdf_path))
+        if checkpoint_dir:
+            save_checkpoint(checkpoint_dir, "api", api_fingerprint, api_response)
+
+        run_utterance_stages(full_text, api_response, request_info["output_path"], config_data, debug_mode, checkpoint_dir)
+        outputs[os.path.basename(pdf_path)] = request_info["output_path"]
+
+    print(f"Collected Message Batch {batch_id}: {len(outputs)} of {len(manifest['requests'])} files processed.")
+    return outputs
+
+
+### 12. MAIN FUNCTION ###
 
 def main():
     # Main function to process a PDF transcript and get AI analysis.
@@ -1182,6 +3247,19 @@ def main():
     parser = argparse.ArgumentParser(description='Extract and analyze earnings call transcript using Claude API.')
     parser.add_argument('pdf_path', nargs='?', help='Path to the PDF transcript (optional, will use test file if not provided)')
     parser.add_argument('--output', '-o', help='Output JSON file path (optional)')
+    parser.add_argument('--batch', metavar='DIR', help='Process every PDF in DIR using a process pool')
+    parser.add_argument('--workers', type=int, help='Number of worker processes for --batch (default: CPU count)')
+    parser.add_argument('--submit-batch', metavar='DIR', help='Submit prompts of all pending PDFs in DIR as one Message Batch')
+    parser.add_argument('--collect-batch', metavar='BATCH_ID', nargs='?', const='', help='Collect results of a Message Batch (default: latest submitted)')
+    parser.add_argument('--page-workers', type=int, help='Number of processes extracting pages of a single PDF (0: CPU count)')
+    parser.add_argument('--layout-mode', action='store_true', help='Extract text span by span with BOLD tags from font flags and without decorative Q/A markers')
+    parser.add_argument('--strip-header-footer', action='store_true', help='Remove header and footer blocks repeating across pages at extraction')
+    parser.add_argument('--no-cache', action='store_true', help='Always call the API, ignoring cached responses')
+    parser.add_argument('--compress-prompt', action='store_true', help='Send only candidate attribution lines and first/last pages to the API')
+    parser.add_argument('--build-registry', action='store_true', help='Build the known-attribution registry from the final JSON folder')
+    parser.add_argument('--spacy-worker', action='store_true', help='Keep the spaCy model loaded and serve the spaCy stage of other runs')
+    parser.add_argument('--validate-pipe-profile', action='store_true', help='Compare spaCy suggestions of the configured pipe profile with the full pipeline')
+    parser.add_argument('--from-stage', choices=PIPELINE_STAGES, help='Rerun from this stage, loading earlier stages from valid checkpoints')
     
     args = parser.parse_args()
 
@@ -1198,6 +3276,36 @@ def main():
     transcripts_pdf_folder = folder_paths['transcripts_pdf_folder']
     final_json_folder = folder_paths['final_json_folder']
 
+    if args.page_workers is not None:
+        config_data.setdefault("extraction_setup", {})["page_workers"] = args.page_workers
+    if args.layout_mode:
+        config_data.setdefault("extraction_setup", {})["layout_mode"] = True
+    if args.strip_header_footer:
+        config_data.setdefault("extraction_setup", {})["strip_header_footer"] = True
+    if args.compress_prompt:
+        config_data.setdefault("prompt_setup", {})["compress_transcript"] = True
+
+    if args.spacy_worker:
+        run_spacy_worker(config_data)
+        return
+
+    if args.build_registry:
+        build_attribution_registry(final_json_folder, get_registry_setup(config_data)["registry_path"])
+        return
+
+    # Message Batches mode
+    if args.submit_batch:
+        submit_message_batch(args.submit_batch, config_data, args.workers)
+        return
+    if args.collect_batch is not None:
+        collect_message_batch(config_data, args.collect_batch or None, debug_mode)
+        return
+
+    # Batch mode
+    if args.batch:
+        run_batch(args.batch, config_data, args.workers, debug_mode, not args.no_cache, args.from_stage)
+        return
+
     # Determine the file to process
     if args.pdf_path:
         file_path = args.pdf_path
@@ -1210,53 +3318,30 @@ def main():
         print("Error: No PDF path provided and test mode is not enabled.")
         return
 
-    # Extract text from PDF
-    print(f"Extracting text from {file_path}...")
-    full_text = text_processing_pipeline(file_path, config_data, debug_mode)
-    
+    if args.validate_pipe_profile:
+        validate_pipe_profile(file_path, config_data)
+        return
 
-    # Extract potential speaker attributions
+    # Extract text from PDF and potential speaker attributions
+    print(f"Extracting text from {file_path}...")
     print("Extracting speaker attributions using SpaCy...")
-    # nlp = spacy.load("en_core_web_trf")  # optional: transformer model for better accuracy
-    nlp = spacy.load("en_core_web_sm")
-
-    potential_attributions, formatted_patterns = extract_speaker_attributions(full_text, nlp, config_data, debug_mode)
-    spacy_patterns = (potential_attributions, formatted_patterns)
-    operator_attributions = get_operator_attributions(full_text)
+    checkpoint_dir = get_checkpoint_dir(config_data, file_path)
+    full_text, spacy_patterns, operator_attributions = run_local_stages(file_path, config_data, None, debug_mode, checkpoint_dir, args.from_stage)
 
-    # Make API call
-    print("Sending text to API for analysis...")
-    api_response = API_call(full_text, spacy_patterns, operator_attributions, config_data, debug_mode)
-    
-    # Check for errors in the API call result
-    if "error" in api_response:
-        print(f"Error: {api_response['error']}")
-        return
-    
-    # Get utterances
-    utterances = get_utterances(full_text, api_response, config_data, debug_mode)
-    
-    # Clean utterances
-    cleaned_utterances = clean_utterances(utterances, api_response)
-    
     # Determine output path
     if args.output:
         output_path = args.output
     else:
         output_path = f"{final_json_folder}/{file_name.replace('.pdf', '_final.json')}"
-    
-    # Create and save final JSON
-    create_and_save_final_json(api_response, cleaned_utterances, output_path, debug_mode)
 
-    # Check if token_counts is available
-    if "token_counts" in api_response:
-        print(f"Input tokens: {api_response['token_counts']['input_tokens']}")
-        print(f"Output tokens: {api_response['token_counts']['output_tokens']}")
-        print(f"Total tokens: {api_response['token_counts']['total_tokens']}")
-        print(f"Estimated cost: ${api_response['cost_estimate']['total_cost_usd']:.2f}")
-    else:
-        print("Token counts not available in the API response.")
+    # Make API call, get and clean utterances, save final JSON
+    print("Sending text to API for analysis...")
+    api_response = run_llm_stages(full_text, spacy_patterns, operator_attributions, output_path, config_data, debug_mode, not args.no_cache, checkpoint_dir, args.from_stage, file_name)
+    if "error" in api_response:
+        return
+
+    print_token_counts(api_response)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()